@@ -1,10 +1,19 @@
 import argparse
 
+import paths
+
+from backends import BACKENDS, DEFAULT_BACKEND
+from tools.main_tools import LOOKUP_CACHE_SIZE
+
 
 class Arguments(object):
     def __init__(self, json_output, user_patterns_file,
                  user_inference_directory, user_services_directory,
-                 progress_output, file_output):
+                 progress_output, file_output, backend, display_filter,
+                 jobs, shards, interface, report_interval, idle_timeout,
+                 activity_retention, ndjson_output, events_interval,
+                 checkpoint_file, checkpoint_interval, resume,
+                 tools_database, lookup_cache_size):
 
         self.json_output = json_output
         self.progress_output = progress_output
@@ -12,6 +21,25 @@ class Arguments(object):
         self.user_inference_directory = user_inference_directory
         self.user_services_directory = user_services_directory
         self.file_output = file_output
+        self.backend = backend
+        self.display_filter = display_filter
+        self.jobs = jobs
+        self.shards = shards
+        self.interface = interface
+        self.report_interval = report_interval
+        self.idle_timeout = idle_timeout
+        self.activity_retention = activity_retention
+        self.ndjson_output = ndjson_output
+        self.events_interval = events_interval
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.tools_database = tools_database
+        self.lookup_cache_size = lookup_cache_size
+
+        # Errors and progress are also reported as JSON
+        if self.ndjson_output:
+            self.json_output = True
 
         self.add_final_character()
 
@@ -35,7 +63,7 @@ class Arguments(object):
             description="Recognize devices of a private network by sniffing NAT'd traffic",
             epilog="For suggestions or bug report, go to https://github.com/sonarwan/sonarwan-core"
         )
-        parser.add_argument('files', nargs='+', help='List of capture files')
+        parser.add_argument('files', nargs='*', help='List of capture files')
         parser.add_argument("-p", "--patterns", help="User's pattern file")
         parser.add_argument(
             "-s",
@@ -56,8 +84,81 @@ class Arguments(object):
             "--output",
             help="Output file to write report. Works when --json option is NOT set. If not specified report will be shown in stdout"
         )
+        parser.add_argument(
+            "--ndjson",
+            help="Outputs one JSON event per line as soon as devices, apps and services are discovered, activity every --events-interval seconds and final results entity by entity. Events are written to --output if given.",
+            action="store_true")
+        parser.add_argument(
+            "--events-interval",
+            help="Seconds of capture time between activity events in --ndjson mode. Default is 60",
+            type=float,
+            default=60)
         parser.add_argument(
             "--progress",
             help="Updates amount of frames analyzed. Works only with --json option.",
             action="store_true")
+        parser.add_argument(
+            "-b",
+            "--backend",
+            help="Ingestion backend. 'tshark' asks tshark only for the fields SonarWAN needs. 'native' reads pcap and pcapng files without tshark. Default is '{}'".
+            format(DEFAULT_BACKEND),
+            choices=sorted(BACKENDS),
+            default=DEFAULT_BACKEND)
+        parser.add_argument(
+            "-Y",
+            "--display-filter",
+            help="Wireshark display filter applied to frames. Works only with pyshark and tshark backends. Filtered frames are not counted nor analyzed."
+        )
+        parser.add_argument(
+            "--jobs",
+            help="Amount of capture files analyzed in parallel, each one in its own process. DNS answers are not shared between files analyzed in parallel.",
+            type=int,
+            default=1)
+        parser.add_argument(
+            "--shards",
+            help="Splits each capture file in this amount of shards by flow, each one analyzed in its own process. Works only with native backend.",
+            type=int,
+            default=1)
+        parser.add_argument(
+            "-I",
+            "--interface",
+            help="Captures live from this interface instead of reading capture files, reporting periodically until interrupted."
+        )
+        parser.add_argument(
+            "--report-interval",
+            help="Seconds between reports in live mode. Default is 60",
+            type=float,
+            default=60)
+        parser.add_argument(
+            "--idle-timeout",
+            help="Seconds without packets after which a stream is forgotten. 0 forgets streams only when closed. Default is 300",
+            type=float)
+        parser.add_argument(
+            "--activity-retention",
+            help="Seconds of activity kept in live mode reports. Default is 3600",
+            type=float,
+            default=3600)
+        parser.add_argument(
+            "--checkpoint",
+            help="File where the state of the analysis is saved periodically, so it can be resumed with --resume. It is removed when the analysis ends."
+        )
+        parser.add_argument(
+            "--checkpoint-interval",
+            help="Seconds between checkpoints. Default is 300",
+            type=float,
+            default=300)
+        parser.add_argument(
+            "--resume",
+            help="Resumes the analysis from the --checkpoint file, skipping frames already analyzed. Capture files must be the same. Starts from the beginning if there is no checkpoint.",
+            action="store_true")
+        parser.add_argument(
+            "--tools-database",
+            help="File where patterns, inference, service and Mobile Detect databases are saved once loaded, so next runs start faster. It is rebuilt when any of them changes. Default is db/tools.db",
+            default=paths.TOOLS_DATABASE_FILE)
+        parser.add_argument(
+            "--lookup-cache-size",
+            help="Amount of hosts and of IP addresses whose services are remembered, and of user agents whose analysis is remembered. Least recently used ones are forgotten first. Default is {}".
+            format(LOOKUP_CACHE_SIZE),
+            type=int,
+            default=LOOKUP_CACHE_SIZE)
         return parser
@@ -0,0 +1,454 @@
+"""
+Ingestion backends. A backend turns a capture file into an iterable
+of PacketRecord to be consumed by Environment.update
+"""
+
+import io
+import mmap
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import errors
+import dissectors
+import pcap
+import compressed
+
+from constants import Transport, FLOW_SWEEP_INTERVAL
+from dissectors import TLS_CLIENT_HELLO
+from packets import (PacketRecord, get_application, parse_address,
+                     set_dns_answers, zip_dns_answers, DNS_TYPE_A,
+                     DNS_TYPE_AAAA, DNS_TYPE_CNAME)
+
+try:
+    import pyshark
+except ImportError:
+    pyshark = None
+
+READ_BUFFER_SIZE = 1 << 20
+
+# Every protocol, for raw sockets
+ETH_P_ALL = 0x0003
+MAX_FRAME_SIZE = 65535
+
+# Characters that will not show up inside field values
+TSHARK_SEPARATOR = '\x1e'
+TSHARK_AGGREGATOR = '\x1f'
+
+# Only fields consumed by the handlers are requested to tshark.
+# {tls} is replaced by 'ssl' or 'tls' depending on tshark version.
+TSHARK_FIELDS = [
+    'frame.time_epoch',
+    'frame.len',
+    'frame.protocols',
+    'ip.src',
+    'ip.dst',
+    'ipv6.src',
+    'ipv6.dst',
+    'tcp.stream',
+    'tcp.srcport',
+    'tcp.dstport',
+    'tcp.flags',
+    'udp.stream',
+    'udp.srcport',
+    'udp.dstport',
+    'dns.qry.name',
+    'dns.resp.name',
+    'dns.resp.type',
+    'dns.resp.ttl',
+    'dns.a',
+    'dns.aaaa',
+    'dns.cname',
+    'http.request',
+    'http.response',
+    'http.host',
+    'http.user_agent',
+    '{tls}.handshake.type',
+    '{tls}.handshake.ciphersuite',
+    '{tls}.handshake.extensions_server_name',
+]
+
+# Names of TSHARK_FIELDS in rows given to record_from_fields
+TSHARK_FIELD_KEYS = [each.format(tls='tls') for each in TSHARK_FIELDS]
+
+
+class PysharkBackend(object):
+    """Full tshark dissection of every frame through pyshark.
+
+    Compressed files are read by tshark itself, which only knows gzip.
+    """
+
+    supports_sharding = False
+    compressions = ('gzip', )
+
+    def __init__(self, display_filter=None):
+        if pyshark is None:
+            raise errors.BackendNotAvailableError('pyshark')
+        self.display_filter = display_filter
+
+    def read(self, path):
+        cap = pyshark.FileCapture(path, display_filter=self.display_filter)
+        for pkg in cap:
+            yield record_from_pyshark(pkg)
+
+    def live(self, interface, idle_timeout=None):
+        cap = pyshark.LiveCapture(
+            interface=interface, display_filter=self.display_filter)
+        for pkg in cap.sniff_continuously():
+            yield record_from_pyshark(pkg)
+
+
+class TsharkBackend(object):
+    """Runs tshark asking only for the fields consumed by the handlers.
+
+    Rows are streamed into packet records instead of building the
+    full dissection tree of every frame as pyshark does.
+    """
+
+    supports_sharding = False
+    compressions = ('gzip', 'xz', 'zstd')
+
+    def __init__(self, display_filter=None):
+        self.tshark = shutil.which('tshark')
+        if self.tshark is None:
+            raise errors.BackendNotAvailableError('tshark')
+        self.display_filter = display_filter
+
+        tls = self.get_tls_prefix()
+        self.fields = [each.format(tls=tls) for each in TSHARK_FIELDS]
+
+    def get_tls_prefix(self):
+        """Since tshark 3.0 'ssl' protocol is called 'tls'"""
+
+        output = subprocess.check_output([self.tshark, '-v'],
+                                         universal_newlines=True)
+        version = re.search(r'(\d+)\.\d+', output)
+        if version and int(version.group(1)) >= 3:
+            return 'tls'
+        return 'ssl'
+
+    def get_command(self, source):
+        """source are the arguments telling tshark where to read from"""
+
+        command = [
+            self.tshark, '-n', '-T', 'fields', '-E',
+            'separator=' + TSHARK_SEPARATOR, '-E', 'occurrence=a', '-E',
+            'aggregator=' + TSHARK_AGGREGATOR
+        ] + source
+        for each in self.fields:
+            command.extend(['-e', each])
+        if self.display_filter:
+            command.extend(['-Y', self.display_filter])
+        return command
+
+    def read(self, path):
+        if compressed.get_compression(path):
+            # Decompressed here and streamed to tshark through stdin
+            return self.run(['-r', '-'], path)
+        return self.run(['-r', path])
+
+    def live(self, interface, idle_timeout=None):
+        # Line buffered, so every frame is reported as soon as it is captured
+        return self.run(['-i', interface, '-l'])
+
+    def run(self, source, compressed_path=None):
+        """compressed_path is a compressed file to be fed to tshark stdin"""
+
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                self.get_command(source),
+                stdin=subprocess.PIPE if compressed_path else None,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                bufsize=READ_BUFFER_SIZE)
+
+            if compressed_path:
+                threading.Thread(
+                    target=feed_decompressed,
+                    args=(compressed_path, process.stdin),
+                    daemon=True).start()
+
+            try:
+                lines = io.TextIOWrapper(
+                    process.stdout, encoding='utf-8', errors='replace')
+                for line in lines:
+                    yield record_from_fields(
+                        line.rstrip('\n').split(TSHARK_SEPARATOR))
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise errors.TsharkError(stderr.read().decode(
+                    'utf-8', errors='replace'))
+
+
+def feed_decompressed(path, pipe):
+    try:
+        with compressed.open_capture(path, READ_BUFFER_SIZE) as f:
+            shutil.copyfileobj(f, pipe, READ_BUFFER_SIZE)
+    except BrokenPipeError:
+        # tshark exited, its error is reported by TsharkBackend.run
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def record_from_fields(values):
+    """Builds a PacketRecord from a row of tshark output (TSHARK_FIELDS)"""
+
+    fields = dict(zip(TSHARK_FIELD_KEYS, values))
+
+    record = PacketRecord(float(fields['frame.time_epoch']),
+                          int(fields['frame.len']))
+
+    if fields['ip.src']:
+        record.version, record.src = parse_address(first(fields['ip.src']))
+        record.dst = parse_address(first(fields['ip.dst']))[1]
+
+    elif fields['ipv6.src']:
+        record.version, record.src = parse_address(first(fields['ipv6.src']))
+        record.dst = parse_address(first(fields['ipv6.dst']))[1]
+
+    if fields['tcp.stream']:
+        record.transport = Transport.TCP
+        record.src_port = int(first(fields['tcp.srcport']))
+        record.dst_port = int(first(fields['tcp.dstport']))
+        record.tcp_flags = int(first(fields['tcp.flags']), 16)
+
+    elif fields['udp.stream']:
+        record.transport = Transport.UDP
+        record.src_port = int(first(fields['udp.srcport']))
+        record.dst_port = int(first(fields['udp.dstport']))
+
+    record.application = get_application(fields['frame.protocols'].split(':'))
+
+    if fields['dns.qry.name']:
+        record.dns_query = first(fields['dns.qry.name'])
+    if fields['dns.a'] or fields['dns.aaaa']:
+        set_dns_answers(
+            record,
+            zip_dns_answers(
+                fields['dns.resp.name'].split(TSHARK_AGGREGATOR),
+                fields['dns.resp.type'].split(TSHARK_AGGREGATOR),
+                fields['dns.resp.ttl'].split(TSHARK_AGGREGATOR), {
+                    DNS_TYPE_A: aggregated(fields['dns.a']),
+                    DNS_TYPE_AAAA: aggregated(fields['dns.aaaa']),
+                    DNS_TYPE_CNAME: aggregated(fields['dns.cname'])
+                }))
+
+    record.http_request = bool(fields['http.request'])
+    if fields['http.host']:
+        record.http_host = first(fields['http.host'])
+    if fields['http.user_agent']:
+        record.http_user_agent = first(fields['http.user_agent'])
+
+    handshake_types = fields['tls.handshake.type'].split(TSHARK_AGGREGATOR)
+    if str(TLS_CLIENT_HELLO) in handshake_types:
+        record.tls_client_hello = True
+        record.tls_cipher_suites = [
+            int(each, 0) for each in fields['tls.handshake.ciphersuite'].split(
+                TSHARK_AGGREGATOR) if each
+        ]
+        server_name = fields['tls.handshake.extensions_server_name']
+        if server_name:
+            record.tls_server_name = first(server_name)
+
+    return record
+
+
+def first(value):
+    """First occurrence of an aggregated field"""
+    return value.split(TSHARK_AGGREGATOR, 1)[0]
+
+
+def aggregated(value):
+    """Every occurrence of an aggregated field"""
+    return value.split(TSHARK_AGGREGATOR) if value else []
+
+
+def record_from_pyshark(pkg):
+    """Builds a PacketRecord from a packet fully dissected by pyshark"""
+
+    record = PacketRecord(float(pkg.sniff_timestamp), int(pkg.length))
+    layers = [each.layer_name for each in pkg.layers]
+
+    if 'ip' in layers:
+        record.version, record.src = parse_address(pkg.ip.src)
+        record.dst = parse_address(pkg.ip.dst)[1]
+    elif 'ipv6' in layers:
+        record.version, record.src = parse_address(pkg.ipv6.src)
+        record.dst = parse_address(pkg.ipv6.dst)[1]
+
+    if 'tcp' in layers:
+        record.transport = Transport.TCP
+        record.src_port = int(pkg.tcp.srcport)
+        record.dst_port = int(pkg.tcp.dstport)
+        record.tcp_flags = int(pkg.tcp.flags, 16)
+    elif 'udp' in layers:
+        record.transport = Transport.UDP
+        record.src_port = int(pkg.udp.srcport)
+        record.dst_port = int(pkg.udp.dstport)
+
+    record.application = get_application(layers)
+
+    if 'dns' in layers:
+        record.dns_query = getattr(pkg.dns, 'qry_name', None)
+        if hasattr(pkg.dns, 'a') or hasattr(pkg.dns, 'aaaa'):
+            set_dns_answers(record, get_pyshark_dns_answers(pkg.dns))
+
+    if 'http' in layers:
+        record.http_request = hasattr(pkg.http, 'request')
+        record.http_host = getattr(pkg.http, 'host', None)
+        record.http_user_agent = getattr(pkg.http, 'user_agent', None)
+
+    if 'ssl' in layers and hasattr(pkg.ssl, 'record') and pkg.ssl.record.split(
+            ': ')[-1] == 'Client Hello':
+        record.tls_client_hello = True
+        record.tls_cipher_suites = [
+            int(x.raw_value, 16)
+            for x in pkg.ssl._get_all_fields_with_alternates()
+            if x.name == 'ssl.handshake.ciphersuite'
+        ]
+        record.tls_server_name = getattr(
+            pkg.ssl, 'handshake_extensions_server_name', None)
+
+    return record
+
+
+def get_pyshark_dns_answers(layer):
+    def values(name):
+        if not hasattr(layer, name):
+            return []
+        return [each.show for each in getattr(layer, name).all_fields]
+
+    return zip_dns_answers(
+        values('resp_name'), values('resp_type'), values('resp_ttl'), {
+            DNS_TYPE_A: values('a'),
+            DNS_TYPE_AAAA: values('aaaa'),
+            DNS_TYPE_CNAME: values('cname')
+        })
+
+
+class NativeBackend(object):
+    """Pure Python reader for pcap and pcapng files.
+
+    Only protocols and fields consumed by the handlers are decoded.
+    Files are memory mapped and decoded in place, without copying frames.
+    Compressed files are decompressed as a stream instead.
+    """
+
+    supports_sharding = True
+    compressions = ('gzip', 'xz', 'zstd')
+
+    def __init__(self, display_filter=None):
+        if display_filter:
+            raise errors.UnsupportedDisplayFilterError('native')
+
+    def read(self, path, shard=None):
+        """When shard is given as (index, count), only frames of that shard
+        and DNS frames are returned. See dissectors.dissect
+        """
+
+        if compressed.get_compression(path):
+            with compressed.open_capture(path, READ_BUFFER_SIZE) as f:
+                yield from self.dissect_frames(pcap.read_frames(f), shard)
+            return
+
+        with open(path, 'rb') as f:
+            buffer = map_file(f)
+            reader = pcap.BufferReader(buffer)
+            try:
+                yield from self.dissect_frames(
+                    pcap.read_frames(reader), shard)
+            finally:
+                # Views of the mapping must be released before closing it
+                reader.release()
+                close_map(buffer)
+
+    def dissect_frames(self, frames, shard=None):
+        streams = dissectors.StreamTable()
+        next_expiration = None
+
+        for timestamp, length, linktype, data in frames:
+            record = dissectors.dissect(timestamp, length, linktype, data,
+                                        streams, shard)
+            if record is not None:
+                yield record
+
+            if next_expiration is None:
+                next_expiration = timestamp + FLOW_SWEEP_INTERVAL
+            elif timestamp >= next_expiration:
+                streams.expire_closed(timestamp)
+                next_expiration = timestamp + FLOW_SWEEP_INTERVAL
+
+    def live(self, interface, idle_timeout=None):
+        """Captures from interface with a raw socket. Only available in Linux.
+
+        Conversations idle for idle_timeout seconds are forgotten.
+        """
+
+        streams = dissectors.StreamTable()
+        last_expiration = time.time()
+
+        with socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                           socket.htons(ETH_P_ALL)) as sock:
+            sock.bind((interface, 0))
+
+            while True:
+                data = sock.recv(MAX_FRAME_SIZE)
+                now = time.time()
+
+                yield dissectors.dissect(now, len(data),
+                                         dissectors.LINKTYPE_ETHERNET, data,
+                                         streams)
+
+                if idle_timeout and now - last_expiration > idle_timeout:
+                    streams.expire(now - idle_timeout)
+                    last_expiration = now
+
+
+def map_file(f):
+    """Read only memory map of the whole file"""
+
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files can not be mapped
+        raise errors.InvalidCaptureFileError()
+
+    # Frames are read once, from start to end
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        buffer.madvise(mmap.MADV_SEQUENTIAL)
+
+    return buffer
+
+
+def close_map(buffer):
+    try:
+        buffer.close()
+    except BufferError:
+        # Frames are still referenced, for example by a traceback.
+        # The mapping is closed when they are collected
+        pass
+
+
+BACKENDS = {
+    'pyshark': PysharkBackend,
+    'tshark': TsharkBackend,
+    'native': NativeBackend,
+}
+
+DEFAULT_BACKEND = 'pyshark'
+
+
+def create_backend(name, display_filter=None):
+    return BACKENDS[name](display_filter)
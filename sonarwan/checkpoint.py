@@ -0,0 +1,75 @@
+"""
+Snapshots of the analysis state, so a run over many capture files can be
+resumed after a crash.
+
+A checkpoint keeps the state of the Environment and of its reporter, so
+incremental output goes on with the same numbers, together with the position
+reached: index of the capture file being analyzed and amount of its frames
+already analyzed. Frames before that position are read again on resume,
+so backends know the conversations they belong to (as the TLS ones, whose
+payload is not decoded), but they are not analyzed.
+"""
+
+import gzip
+import os
+import pickle
+import time
+
+import errors
+
+CHECKPOINT_VERSION = 6
+
+
+class Checkpoint(object):
+    def __init__(self, files, file_index, frames, packets, state,
+                 reporter_state):
+        self.version = CHECKPOINT_VERSION
+        self.files = files
+        self.file_index = file_index
+        self.frames = frames
+        self.packets = packets
+        self.state = state
+        self.reporter_state = reporter_state
+
+
+class Checkpointer(object):
+    """Saves a checkpoint to path at most every interval seconds"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.next_save = time.time() + interval
+
+    def due(self):
+        return time.time() >= self.next_save
+
+    def save(self, checkpoint):
+        # Written aside and then renamed, so a crash while saving
+        # does not lose the previous checkpoint
+        temporal = self.path + '.tmp'
+        with gzip.open(temporal, 'wb', compresslevel=1) as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal, self.path)
+
+        self.next_save = time.time() + self.interval
+
+    def load(self):
+        """Returns last saved Checkpoint or None if there is none"""
+
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with gzip.open(self.path, 'rb') as f:
+                checkpoint = pickle.load(f)
+        except Exception:
+            raise errors.InvalidCheckpointError(self.path)
+
+        if getattr(checkpoint, 'version', None) != CHECKPOINT_VERSION:
+            raise errors.InvalidCheckpointError(self.path)
+
+        return checkpoint
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,71 @@
+"""
+Compressed capture files, decompressed as a stream while being read.
+
+The compression of a file is known by its extension, as in capture.pcap.gz.
+zstd requires the zstandard package.
+"""
+
+import gzip
+import io
+import lzma
+
+import errors
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extension to compression name
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+
+def get_compression(path):
+    """Compression name of path or None if it is not compressed"""
+
+    for extension, name in EXTENSIONS.items():
+        if path.endswith(extension):
+            return name
+    return None
+
+
+def strip_extension(path):
+    """path without its compression extension"""
+
+    for extension in EXTENSIONS:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+
+def is_available(name):
+    return name != 'zstd' or zstandard is not None
+
+
+def open_capture(path, buffer_size):
+    """Binary file object of the decompressed content of path.
+    Decompression is done in reads of buffer_size bytes.
+    """
+
+    name = get_compression(path)
+
+    if name == 'gzip':
+        stream = gzip.GzipFile(path, 'rb')
+    elif name == 'xz':
+        stream = lzma.LZMAFile(path, 'rb')
+    elif name == 'zstd':
+        if zstandard is None:
+            raise errors.CompressionNotAvailableError(name)
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'),
+            read_size=buffer_size,
+            read_across_frames=True,
+            closefd=True)
+    else:
+        return open(path, 'rb', buffering=buffer_size)
+
+    return io.BufferedReader(stream, buffer_size)
@@ -1,6 +1,31 @@
 from enum import Enum
 
+TCP_FIN = 0x01
+TCP_RST = 0x04
+
+# Seconds of capture time between sweeps of closed and idle streams
+FLOW_SWEEP_INTERVAL = 10
+
+# Seconds a closed TCP stream is kept, for the last packets of the close
+CLOSED_FLOW_LINGER = 5
+
 
 class Transport(Enum):
     TCP = 1
     UDP = 2
+
+
+class Application(Enum):
+    HTTP = 1
+    TLS = 2
+    DNS = 3
+    OTHER = 4
+
+
+class FlowOwner(Enum):
+    """What a TCP or UDP stream was attributed to"""
+
+    DEVICE = 1
+    SERVICE = 2
+    # Not attributed yet. Its activity is kept until it is
+    TEMPORAL = 3
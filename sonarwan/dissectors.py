@@ -0,0 +1,473 @@
+"""
+Pure Python decoders for the protocols SonarWAN consumes.
+
+Frames are decoded only as deep as handlers need: link layer, IPv4 or IPv6,
+TCP or UDP and then DNS answers, HTTP request line with Host and User-Agent
+headers, or TLS ClientHello. Everything else is left undecoded.
+
+Decoded fields are written to a PacketRecord. Frames can be bytes or
+memoryview, only the few bytes that are kept are copied.
+
+Once a TCP conversation is known to be TLS its payload is not decoded
+again, as it is encrypted and no handler can get anything from it.
+"""
+
+import socket
+import struct
+
+from constants import (Application, Transport, TCP_FIN, TCP_RST,
+                       CLOSED_FLOW_LINGER)
+from packets import (PacketRecord, get_shard, set_dns_answers, DNS_TYPE_A,
+                     DNS_TYPE_AAAA, DNS_TYPE_CNAME)
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+IPV6_FRAGMENT = 44
+IPV6_EXTENSION_HEADERS = (0, 43, 60, IPV6_FRAGMENT)
+
+DNS_PORT = 53
+DNS_MAX_POINTERS = 16
+
+# Ports tshark decodes as HTTP by default, so payload that is not a request
+# nor a response header is still HTTP, as a continuation
+HTTP_PORTS = (80, 1900, 2710, 2869, 3128, 3132, 5985, 8080, 8088, 11371)
+
+HTTP_METHODS = (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ',
+                b'OPTIONS ', b'CONNECT ', b'PATCH ', b'TRACE ')
+
+# Bytes of payload needed to recognize HTTP
+HTTP_PREFIX_SIZE = max(len(each) for each in HTTP_METHODS)
+
+TLS_CONTENT_TYPES = (20, 21, 22, 23)
+TLS_HANDSHAKE = 22
+TLS_CLIENT_HELLO = 1
+TLS_SERVER_NAME = 0
+TLS_VERSIONS = {
+    0: 'SSLv3',
+    1: 'TLSv1',
+    2: 'TLSv1.1',
+    3: 'TLSv1.2',
+    4: 'TLSv1.3',
+}
+
+IPV4_HEADER = struct.Struct('>BBHHHBBHII')
+TCP_HEADER = struct.Struct('>HHIIH')
+UDP_HEADER = struct.Struct('>HH')
+DNS_HEADER = struct.Struct('>HHHH')
+DNS_RECORD = struct.Struct('>HHIH')
+
+
+class Conversation(object):
+    __slots__ = ('last_time', 'opaque', 'http', 'closed')
+
+    def __init__(self, time):
+        self.last_time = time
+
+        # True when payload has nothing for handlers, as in TLS
+        self.opaque = False
+
+        # HTTP was seen, so the rest of its payload is HTTP too
+        self.http = False
+
+        # FIN or RST was seen
+        self.closed = False
+
+
+class StreamTable(object):
+    """Keeps what was seen of TCP and UDP conversations, so payload of TLS
+    ones is not decoded. Streams are identified by the Environment.
+    """
+
+    def __init__(self):
+        # Endpoints to Conversation
+        self.streams = {}
+
+    def get_conversation(self, transport, src, src_port, dst, dst_port, time):
+        if (src, src_port) <= (dst, dst_port):
+            key = (transport, src, src_port, dst, dst_port)
+        else:
+            key = (transport, dst, dst_port, src, src_port)
+
+        conversation = self.streams.get(key)
+        if conversation is None:
+            conversation = Conversation(time)
+            self.streams[key] = conversation
+        else:
+            conversation.last_time = time
+        return conversation
+
+    def expire(self, time):
+        """Forgets conversations without frames since time"""
+
+        idle = [k for k, v in self.streams.items() if v.last_time < time]
+        for each in idle:
+            del self.streams[each]
+
+    def expire_closed(self, time):
+        """Forgets conversations closed CLOSED_FLOW_LINGER seconds before time"""
+
+        limit = time - CLOSED_FLOW_LINGER
+        closed = [
+            k for k, v in self.streams.items()
+            if v.closed and v.last_time < limit
+        ]
+        for each in closed:
+            del self.streams[each]
+
+
+def dissect(timestamp, length, linktype, data, streams, shard=None):
+    """Returns a PacketRecord with every field that could be decoded from frame.
+
+    When shard is given as (index, count), frames that belong to other shards
+    are not decoded further than transport headers and None is returned.
+    DNS frames are returned for every shard.
+    """
+
+    record = PacketRecord(timestamp, length)
+    payload = decode_headers(linktype, data, record)
+
+    if shard is not None and get_shard(record, shard[1]) != shard[0] and (
+            not is_dns(record)):
+        return None
+
+    if record.transport is not None:
+        conversation = streams.get_conversation(
+            record.transport, record.src, record.src_port, record.dst,
+            record.dst_port, timestamp)
+
+        if record.tcp_flags & (TCP_FIN | TCP_RST):
+            conversation.closed = True
+
+        if conversation.opaque:
+            if payload:
+                record.application = Application.TLS
+
+        elif payload is not None:
+            decode_payload(payload, record)
+            if record.application is Application.TLS:
+                conversation.opaque = True
+            elif record.application is Application.HTTP:
+                conversation.http = True
+            elif record.application is Application.OTHER and (
+                    conversation.http or record.src_port in HTTP_PORTS
+                    or record.dst_port in HTTP_PORTS):
+                record.application = Application.HTTP
+
+    return record
+
+
+def decode_headers(linktype, data, record):
+    """Decodes link, network and transport headers. Returns transport payload"""
+
+    link = decode_link(linktype, data)
+    if link is None:
+        return None
+
+    ethertype, offset = link
+    if ethertype == ETHERTYPE_IPV4:
+        network = decode_ipv4(data, offset, record)
+    elif ethertype == ETHERTYPE_IPV6:
+        network = decode_ipv6(data, offset, record)
+    else:
+        return None
+
+    if network:
+        protocol, offset, end, first_fragment = network
+
+        # Only first fragment has transport header
+        if first_fragment and protocol == IPPROTO_TCP:
+            return decode_tcp(data, offset, end, record)
+        elif first_fragment and protocol == IPPROTO_UDP:
+            return decode_udp(data, offset, end, record)
+
+    return None
+
+
+def decode_payload(payload, record):
+    if record.transport is Transport.TCP:
+        prefix = bytes(payload[:HTTP_PREFIX_SIZE])
+        if prefix.startswith(HTTP_METHODS):
+            record.application = Application.HTTP
+            decode_http_request(payload, record)
+        elif prefix.startswith(b'HTTP/'):
+            record.application = Application.HTTP
+        elif is_tls_record(payload):
+            record.application = Application.TLS
+            decode_tls(payload, record)
+        elif len(payload):
+            # As tshark, that ends layers of unknown payload with data
+            record.application = Application.OTHER
+
+    elif is_dns(record):
+        record.application = Application.DNS
+        decode_dns(payload, record)
+
+
+def is_dns(record):
+    return record.transport is Transport.UDP and (
+        record.src_port == DNS_PORT or record.dst_port == DNS_PORT)
+
+
+def decode_link(linktype, data):
+    """Returns (ethertype, offset of network layer) or None"""
+
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None
+        ethertype = (data[12] << 8) | data[13]
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN and len(data) >= offset + 4:
+            ethertype = (data[offset + 2] << 8) | data[offset + 3]
+            offset += 4
+        return ethertype, offset
+
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return None
+        return (data[14] << 8) | data[15], 16
+
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 20:
+            return None
+        return (data[0] << 8) | data[1], 20
+
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if len(data) < 5:
+            return None
+        # Family is in host byte order for NULL, so the IP version is used
+        version = data[4] >> 4
+        return ETHERTYPE_IPV6 if version == 6 else ETHERTYPE_IPV4, 4
+
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        if not data:
+            return None
+        version = data[0] >> 4
+        return ETHERTYPE_IPV6 if version == 6 else ETHERTYPE_IPV4, 0
+
+    return None
+
+
+def decode_ipv4(data, offset, record):
+    """Returns (protocol, payload offset, payload end, first fragment) or None"""
+
+    if len(data) - offset < 20:
+        return None
+
+    (version_ihl, _, total, _, fragment, _, protocol, _, src,
+     dst) = IPV4_HEADER.unpack_from(data, offset)
+
+    record.version = 4
+    record.src = src
+    record.dst = dst
+
+    # Total length can be zero when segmentation was offloaded
+    end = min(len(data), offset + total) if total else len(data)
+
+    return (protocol, offset + (version_ihl & 0x0f) * 4, end,
+            fragment & 0x1fff == 0)
+
+
+def decode_ipv6(data, offset, record):
+    """Returns (protocol, payload offset, payload end, first fragment) or None"""
+
+    if len(data) - offset < 40:
+        return None
+
+    payload_length = (data[offset + 4] << 8) | data[offset + 5]
+    protocol = data[offset + 6]
+
+    record.version = 6
+    record.src = int.from_bytes(data[offset + 8:offset + 24], 'big')
+    record.dst = int.from_bytes(data[offset + 24:offset + 40], 'big')
+
+    end = min(len(data), offset + 40 + payload_length
+              ) if payload_length else len(data)
+
+    position = offset + 40
+    first_fragment = True
+    while protocol in IPV6_EXTENSION_HEADERS and position + 8 <= end:
+        if protocol == IPV6_FRAGMENT:
+            fragment_offset = (data[position + 2] << 8) | data[position + 3]
+            first_fragment = fragment_offset >> 3 == 0
+            size = 8
+        else:
+            size = (data[position + 1] + 1) * 8
+        protocol = data[position]
+        position += size
+
+    return protocol, position, end, first_fragment
+
+
+def decode_tcp(data, offset, end, record):
+    if end - offset < 20:
+        return None
+
+    src_port, dst_port, _, _, offset_flags = TCP_HEADER.unpack_from(data,
+                                                                     offset)
+
+    record.transport = Transport.TCP
+    record.src_port = src_port
+    record.dst_port = dst_port
+    record.tcp_flags = offset_flags & 0x1ff
+
+    return data[offset + (offset_flags >> 12) * 4:end]
+
+
+def decode_udp(data, offset, end, record):
+    if end - offset < 8:
+        return None
+
+    src_port, dst_port = UDP_HEADER.unpack_from(data, offset)
+
+    record.transport = Transport.UDP
+    record.src_port = src_port
+    record.dst_port = dst_port
+
+    return data[offset + 8:end]
+
+
+def decode_http_request(payload, record):
+    """Decodes request line, Host and User-Agent"""
+
+    record.http_request = True
+
+    head = bytes(payload).split(b'\r\n\r\n', 1)[0]
+    for line in head.split(b'\r\n')[1:]:
+        name, separator, value = line.partition(b':')
+        if not separator:
+            continue
+
+        name = name.strip().lower()
+        if name == b'host':
+            record.http_host = value.strip().decode('latin-1')
+        elif name == b'user-agent':
+            record.http_user_agent = value.strip().decode('latin-1')
+
+
+def is_tls_record(payload):
+    return (len(payload) >= 5 and payload[0] in TLS_CONTENT_TYPES and
+            payload[1] == 3 and payload[2] in TLS_VERSIONS)
+
+
+def decode_tls(payload, record):
+    """Only ClientHello is decoded: cipher suites and server name"""
+
+    if len(payload) < 6 or payload[0] != TLS_HANDSHAKE or payload[
+            5] != TLS_CLIENT_HELLO:
+        return
+
+    record.tls_client_hello = True
+
+    try:
+        # Record header, handshake header, client version and random
+        position = 5 + 4 + 2 + 32
+        position += 1 + payload[position]
+
+        size = struct.unpack_from('>H', payload, position)[0]
+        record.tls_cipher_suites = list(
+            struct.unpack_from('>{}H'.format(size // 2), payload, position +
+                               2))
+        position += 2 + size
+        position += 1 + payload[position]
+
+        extensions_end = position + 2 + struct.unpack_from('>H', payload,
+                                                           position)[0]
+        position += 2
+        while position + 4 <= extensions_end:
+            kind, size = struct.unpack_from('>HH', payload, position)
+            if kind == TLS_SERVER_NAME:
+                # Server name list length, name type and name length
+                name_size = struct.unpack_from('>H', payload, position + 7)[0]
+                record.tls_server_name = str(
+                    payload[position + 9:position + 9 + name_size],
+                    'latin-1')
+            position += 4 + size
+
+    except (IndexError, struct.error):
+        # ClientHello continues in next segment
+        pass
+
+
+def decode_dns(payload, record):
+    """Decodes query name and A, AAAA and CNAME answers"""
+
+    if len(payload) < 12:
+        return
+
+    _, _, questions, count = DNS_HEADER.unpack_from(payload)
+
+    answers = []
+
+    try:
+        position = 12
+        for i in range(questions):
+            name, position = read_dns_name(payload, position)
+            if i == 0:
+                record.dns_query = name
+            position += 4
+
+        for i in range(count):
+            name, position = read_dns_name(payload, position)
+            kind, _, ttl, size = DNS_RECORD.unpack_from(payload, position)
+            position += 10
+            if kind == DNS_TYPE_A and size == 4:
+                answers.append((name, kind, socket.inet_ntoa(
+                    payload[position:position + 4]), ttl))
+            elif kind == DNS_TYPE_AAAA and size == 16:
+                answers.append((name, kind, socket.inet_ntop(
+                    socket.AF_INET6, payload[position:position + 16]), ttl))
+            elif kind == DNS_TYPE_CNAME:
+                answers.append((name, kind, read_dns_name(payload,
+                                                          position)[0], ttl))
+            position += size
+
+    except (IndexError, ValueError, struct.error):
+        # Truncated or malformed message, keep what could be decoded
+        pass
+
+    set_dns_answers(record, answers)
+
+
+def read_dns_name(payload, position):
+    """Returns name starting at position and the position after it.
+    Compression pointers are followed.
+    """
+
+    labels = []
+    end = None
+    pointers = 0
+
+    while True:
+        size = payload[position]
+
+        if size & 0xc0 == 0xc0:
+            if end is None:
+                end = position + 2
+            pointers += 1
+            if pointers > DNS_MAX_POINTERS:
+                raise ValueError('DNS compression loop')
+            position = ((size & 0x3f) << 8) | payload[position + 1]
+            continue
+
+        position += 1
+        if size == 0:
+            break
+
+        labels.append(str(payload[position:position + size], 'latin-1'))
+        position += size
+
+    return '.'.join(labels), end if end is not None else position
@@ -1,11 +1,47 @@
-from models import Device
-from constants import Transport
-from utils import sort_by_value
+from models import Device, DeviceIndex, ServiceCollection
+from hosts import HostCache
+from constants import (Application, FlowOwner, Transport, TCP_FIN, TCP_RST,
+                       FLOW_SWEEP_INTERVAL, CLOSED_FLOW_LINGER)
+from utils import sort_by_value, get_time_bucket
 
+import events
 import streams
 import handlers
 
 
+# Everything learned from analyzed packets. See get_state
+STATE_ATTRIBUTES = ('start_time', 'end_time', 'devices', 'authorless_services',
+                    'host_cache', 'flows', 'generation')
+
+
+def get_flow_key(pkg):
+    """Transport and endpoints of pkg. Both directions have the same key"""
+
+    if (pkg.src, pkg.src_port) <= (pkg.dst, pkg.dst_port):
+        return (pkg.transport, pkg.src, pkg.src_port, pkg.dst, pkg.dst_port)
+    return (pkg.transport, pkg.dst, pkg.dst_port, pkg.src, pkg.src_port)
+
+
+class Flow(object):
+    """Entry of the flow table. target is the Device or AuthorlessService
+    the stream belongs to, or its activity if it is temporal.
+
+    stream identifies the stream in Devices, Apps and AuthorlessServices.
+    It is the flow key followed by the generation the flow was created in.
+    """
+
+    __slots__ = ('owner', 'target', 'stream', 'last_seen', 'closed')
+
+    def __init__(self, owner, target, stream, time):
+        self.owner = owner
+        self.target = target
+        self.stream = stream
+        self.last_seen = time
+
+        # FIN or RST was seen
+        self.closed = False
+
+
 class Environment(object):
     """The Environment keeps track of Devices and Authorless Services"""
 
@@ -15,7 +51,12 @@ class Environment(object):
         self.end_time = None
 
         self.devices = []
-        self.authorless_services = []
+        self.authorless_services = ServiceCollection()
+
+        self.device_index = DeviceIndex()
+
+        # Incremented every time a device is added or its characteristics change
+        self.devices_version = 0
 
         self.http_handler = handlers.HTTPHandler(self)
         self.tcp_handler = handlers.TCPHandler(self)
@@ -28,15 +69,47 @@ class Environment(object):
         self.service_analyzer = service_analyzer
 
         # Cache for DNS queries
-        self.address_host = {}
+        self.host_cache = HostCache()
 
-    def sort_authorless_services(self):
-        as_map = {}
-        for each_authorless_service in self.authorless_services:
-            as_map[each_authorless_service] = each_authorless_service.get_size(
-            )
+        # Seconds without packets after which a stream is forgotten.
+        # None means streams are only forgotten when closed.
+        self.idle_timeout = None
 
-        sort_by_value(self.authorless_services, as_map)
+        # Told about every discovery, for incremental output
+        self.reporter = events.Reporter()
+
+        # Flow key (see get_flow_key) to Flow. Streams are identified by
+        # their endpoints, so flows are kept between capture files
+        self.flows = {}
+
+        # Incremented every time flows are forgotten, so a stream that reuses
+        # the endpoints of a forgotten one is a different stream
+        self.generation = 0
+
+        self.next_sweep = None
+
+    def set_reporter(self, reporter):
+        self.reporter = reporter
+        reporter.install()
+
+    def get_state(self):
+        """State to be checkpointed. Analysis tools are not included"""
+        return {k: getattr(self, k) for k in STATE_ATTRIBUTES}
+
+    def set_state(self, state):
+        """Restores a state returned by get_state"""
+
+        for k, v in state.items():
+            setattr(self, k, v)
+
+        self.device_index = DeviceIndex()
+        for each in self.devices:
+            each.inference_engine = self.inference_engine
+            self.device_index.add(each)
+        self.devices_version += 1
+
+    def sort_authorless_services(self):
+        self.authorless_services.sort_by_size()
 
     def sort_devices(self):
         d_map = {}
@@ -51,46 +124,47 @@ class Environment(object):
         self.sort_authorless_services()
         self.sort_devices()
 
-    def prepare(self):
-        """Resets all stream maps when new file is going to be processed"""
-
-        # Stream to device
-        self.device_stream_map = {
-            Transport.TCP: {},
-            Transport.UDP: {},
-        }
-
-        # Stream to service
-        self.service_stream_map = {
-            Transport.TCP: {},
-            Transport.UDP: {},
-        }
-
-        # Currently unasigned streams.
-        # Saves activity only
-        self.temporal_stream_map = {
-            Transport.TCP: {},
-            Transport.UDP: {},
-        }
-
     def update(self, pkg):
         """A handler will process the package based on type of package"""
-        self.update_time_boundaries(pkg.sniff_time)
-
-        if hasattr(pkg, 'ip'):
-            layers = [each.layer_name for each in pkg.layers]
-
-            if 'http' in layers and 'tcp' in layers:
-                self.http_handler.process(pkg)
-
-            elif layers[-1] == 'tcp' or 'ssl' in layers:
-                self.tcp_handler.process(pkg)
-
-            elif 'dns' == layers[-1]:
+        self.update_time_boundaries(pkg.timestamp)
+
+        if self.next_sweep is None:
+            self.next_sweep = pkg.timestamp + FLOW_SWEEP_INTERVAL
+        elif pkg.timestamp >= self.next_sweep:
+            self.sweep_flows(pkg.timestamp)
+            self.next_sweep = pkg.timestamp + FLOW_SWEEP_INTERVAL
+
+        if pkg.version in (4, 6):
+            transport, application = pkg.transport, pkg.application
+
+            flow = None
+            if transport is not None:
+                key = get_flow_key(pkg)
+                flow = self.flows.get(key)
+                if flow is None:
+                    pkg.stream = key + (self.generation, )
+                else:
+                    flow.last_seen = pkg.timestamp
+                    pkg.stream = flow.stream
+
+            if application is Application.HTTP and transport is Transport.TCP:
+                self.http_handler.process(pkg, flow)
+
+            elif transport is Transport.TCP and (
+                    application is None or application is Application.TLS):
+                self.tcp_handler.process(pkg, flow)
+
+            elif application is Application.DNS:
                 self.dns_handler.process(pkg)
 
-            elif 'udp' in layers:
-                self.udp_handler.process(pkg)
+            elif transport is Transport.UDP:
+                self.udp_handler.process(pkg, flow)
+
+            if pkg.tcp_flags & (TCP_FIN | TCP_RST):
+                # Flow could have been created by the handler
+                flow = self.flows.get(key)
+                if flow is not None:
+                    flow.closed = True
 
     def update_time_boundaries(self, time):
         if self.start_time is None:
@@ -100,64 +174,148 @@ class Environment(object):
         self.start_time = min(self.start_time, time)
         self.end_time = max(self.end_time, time)
 
-    def find_host(self, address):
-        """Returns host if the IP address was answer from a DNS query.
+    def sweep_flows(self, time):
+        """Forgets streams closed CLOSED_FLOW_LINGER seconds before time and,
+        if idle_timeout is set, streams without packets in the idle_timeout
+        seconds before time.
+
+        Activity of streams of devices and authorless services is already
+        accounted in them. Activity of temporal streams is dropped.
+        """
+
+        closed_limit = time - CLOSED_FLOW_LINGER
+        idle_limit = time - self.idle_timeout if self.idle_timeout else None
+
+        expired = [
+            k for k, v in self.flows.items()
+            if (v.closed and v.last_seen < closed_limit) or (
+                idle_limit is not None and v.last_seen < idle_limit)
+        ]
+
+        if expired:
+            self.generation += 1
+
+        for key in expired:
+            flow = self.flows.pop(key)
+
+            if flow.owner is FlowOwner.SERVICE:
+                flow.target.forget_stream(key[0], flow.stream)
+            elif flow.owner is FlowOwner.DEVICE:
+                flow.target.forget_stream(flow.stream)
+
+    def evict_activity_before(self, time):
+        """Drops activity older than time. Authorless services left without
+        activity nor streams are removed.
+        """
+
+        time_string = get_time_bucket(time)
+
+        for each in self.devices:
+            each.drop_activity_before(time_string)
+
+        for each in self.authorless_services:
+            each.drop_activity_before(time_string)
+
+        removed = [
+            each for each in self.authorless_services
+            if not each.activity and each.is_empty()
+        ]
+        for each in removed:
+            self.authorless_services.remove(each)
+            self.reporter.authorless_service_removed(each)
+
+    def find_host(self, address, time):
+        """Returns host if the IP address was answer from a DNS query
+        not expired at capture time.
         
         If that IP was answer for many url queries, method return None to avoid
         incorrect behaviour when name of url is url itself (for example x1.wp.com)
         """
-        ret = self.address_host.get(address)
+        ret = self.host_cache.find(address, time)
         if ret == None or len(ret) > 1:
             return None
-        return ret[0]
-
-    def already_exists_authorless_service(self, name):
-        for each in self.authorless_services:
-            if each.name == name:
-                return True
-        return False
+        return next(iter(ret))
 
     def get_existing_authorless_service(self, name):
-        for each in self.authorless_services:
-            if each.name == name:
-                return each
-        return None
+        return self.authorless_services.get(name)
+
+    def assign_flow(self, pkg, owner, target):
+        """Attributes stream of pkg to target"""
+
+        key = pkg.stream[:-1]
+        flow = self.flows.get(key)
+        if flow is None:
+            self.flows[key] = Flow(owner, target, pkg.stream, pkg.timestamp)
+        else:
+            flow.owner = owner
+            flow.target = target
 
-    def previously_analized_stream(self, pkg):
-        """True if corresponds to device, to authorless_service or to temporal"""
+    def merge(self, partial):
+        """Merges results of another Environment, that analyzed another capture file.
 
-        return self.has_device_from_stream(
-            pkg) or self.has_service_from_stream(
-                pkg) or self.has_temporal_stream(pkg)
+        Devices are merged with best matching device, authorless services by name.
+        """
 
-    def has_temporal_stream(self, pkg):
-        return self.locate(pkg, self.temporal_stream_map) is not None
+        if partial.start_time is not None:
+            self.update_time_boundaries(partial.start_time)
+            self.update_time_boundaries(partial.end_time)
+
+        self.host_cache.merge(partial.host_cache)
+
+        for each in partial.authorless_services:
+            existing = self.get_existing_authorless_service(each.name)
+            if existing:
+                existing.merge(each)
+            else:
+                self.authorless_services.add(each)
+                self.reporter.authorless_service_discovered(each)
+
+        for each in partial.devices:
+            each.inference_engine = self.inference_engine
+
+            device = self.find_matching_device(each)
+            if device:
+                attached = device.merge(each)
+                self.reporter.device_updated(device)
+                for app, service in attached:
+                    self.reporter.service_attached(device, app, service)
+            else:
+                device = each
+                self.devices.append(device)
+                self.reporter.device_merged(device)
+
+            self.device_index.add(device)
+            self.devices_version += 1
+
+    def find_matching_device(self, other):
+        """Best matching device. When many match as well, first one is
+        returned, so merged results do not depend on chance.
+        """
 
-    def has_device_from_stream(self, pkg):
-        return self.locate_device(pkg) is not None
+        device = None
+        max_score = 0
+        for d in self.devices:
+            score = d.merge_score(other)
+            if score > max_score:
+                max_score, device = score, d
 
-    def has_service_from_stream(self, pkg):
-        return self.locate_service(pkg) is not None
+        return device
 
-    def locate_device(self, pkg):
-        return self.locate(pkg, self.device_stream_map)
+    def update_device(self, device, device_args, app_args, stream_number):
+        """Updates characteristics of device (see Device.update) and reports it"""
 
-    def locate_temporal(self, pkg):
-        return self.locate(pkg, self.temporal_stream_map)
+        revision = device.revision
+        device.update(device_args, app_args, stream_number)
 
-    def locate_service(self, pkg):
-        return self.locate(pkg, self.service_stream_map)
+        if device.revision != revision:
+            self.device_index.add(device)
+            self.devices_version += 1
 
-    def locate(self, pkg, structure):
-        try:
-            number = pkg.tcp.stream
-            transport_prot = Transport.TCP
-        except:
-            number = pkg.udp.stream
-            transport_prot = Transport.UDP
-        return structure[transport_prot].get(number)
+        self.reporter.device_updated(device)
 
     def create_device(self):
         device = Device(self.inference_engine)
         self.devices.append(device)
+        self.device_index.add(device)
+        self.devices_version += 1
         return device
@@ -21,3 +21,31 @@ class InvalidCSVInferenceFile(Exception):
 
 class LinuxDistributionListError(Exception):
     pass
+
+
+class InvalidCaptureFileError(Exception):
+    pass
+
+
+class BackendNotAvailableError(Exception):
+    def __init__(self, name):
+        self.name = name
+
+
+class UnsupportedDisplayFilterError(Exception):
+    def __init__(self, name):
+        self.name = name
+
+
+class TsharkError(Exception):
+    pass
+
+
+class InvalidCheckpointError(Exception):
+    def __init__(self, path):
+        self.path = path
+
+
+class CompressionNotAvailableError(Exception):
+    def __init__(self, name):
+        self.name = name
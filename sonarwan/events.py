@@ -0,0 +1,260 @@
+"""
+Incremental output of results while captures are still being analyzed.
+
+The Environment tells its reporter about every device, app, service and
+authorless service as soon as it is discovered. Activity changes are
+accumulated and emitted as deltas every interval seconds of capture time.
+
+NDJSONReporter writes every event as one JSON object per line, so results
+can be consumed before the analysis ends. Final results are also written
+entity by entity, so no full copy of the report is ever built.
+"""
+
+import json
+
+from models import ActivityDataManager, DeviceLess, ServiceLess
+
+# What NDJSONReporter knows of reported entities. See get_state
+STATE_ATTRIBUTES = ('next_flush', 'device_ids', 'app_ids', 'app_counts',
+                    'activity_keys', 'pending')
+
+
+class Reporter(object):
+    """Ignores every event. Used when no incremental output is requested"""
+
+    def install(self):
+        ActivityDataManager.listener = None
+
+    def get_state(self):
+        """State to be checkpointed together with the Environment"""
+        return None
+
+    def set_state(self, state):
+        pass
+
+    def device_updated(self, device):
+        pass
+
+    def device_merged(self, device):
+        pass
+
+    def app_discovered(self, device, app):
+        pass
+
+    def service_attached(self, device, app, service):
+        pass
+
+    def authorless_service_discovered(self, service):
+        pass
+
+    def authorless_service_promoted(self, service, device, removed):
+        pass
+
+    def authorless_service_removed(self, service):
+        pass
+
+    def activity_changed(self, entity, time_string, bytes_count):
+        pass
+
+    def tick(self, time):
+        pass
+
+
+class NDJSONReporter(Reporter):
+    """Writes events as NDJSON to fd.
+
+    Devices and apps are identified by numbers given in order of discovery,
+    authorless services by name.
+    """
+
+    def __init__(self, fd, interval):
+        self.fd = fd
+        self.interval = interval
+        self.next_flush = None
+
+        self.device_ids = {}
+        self.app_ids = {}
+        self.app_counts = {}
+
+        # Entity to key of its activity events
+        self.activity_keys = {}
+
+        # Key to activity not emitted yet
+        self.pending = {}
+
+    def install(self):
+        """Starts receiving activity changes of every device and service"""
+        ActivityDataManager.listener = self
+
+    def get_state(self):
+        """Numbers given to devices and apps and activity not emitted yet, so
+        a resumed analysis goes on with the same numbers
+        """
+
+        return {k: getattr(self, k) for k in STATE_ATTRIBUTES}
+
+    def set_state(self, state):
+        """Restores a state returned by get_state. States of other reporters
+        are ignored
+        """
+
+        if state:
+            for k, v in state.items():
+                setattr(self, k, v)
+
+    def emit(self, event):
+        self.fd.write(
+            json.dumps(
+                event,
+                default=lambda o: o.__dict__,
+                sort_keys=True,
+                separators=(',', ':')) + '\n')
+        self.fd.flush()
+
+    def device_updated(self, device):
+        """Called after every update of device characteristics. New apps of
+        device are also reported.
+        """
+
+        if device not in self.device_ids:
+            self.device_discovered(device)
+
+        for each in device.apps:
+            if each not in self.app_ids:
+                self.app_discovered(device, each)
+
+    def device_discovered(self, device):
+        number = len(self.device_ids)
+        self.device_ids[device] = number
+        self.activity_keys[device] = ('device', number)
+
+        self.emit({
+            'event': 'device_discovered',
+            'device': number,
+            'characteristics': device.characteristics
+        })
+
+    def device_merged(self, device):
+        """A device was detected by another Environment. Everything it
+        contains is reported as discovered.
+        """
+
+        if device in self.device_ids:
+            return
+
+        self.device_updated(device)
+
+        for app in device.apps:
+            for each in app.services:
+                self.service_attached(device, app, each)
+        for each in device.unasigned_services:
+            self.service_attached(device, None, each)
+
+        for k, v in device.activity.items():
+            self.activity_changed(device, k, v)
+
+    def app_discovered(self, device, app):
+        device_number = self.device_ids[device]
+        number = self.app_counts.get(device_number, 0)
+        self.app_counts[device_number] = number + 1
+        self.app_ids[app] = (device_number, number)
+
+        self.emit({
+            'event': 'app_discovered',
+            'device': device_number,
+            'app': number,
+            'characteristics': app.characteristics
+        })
+
+    def service_attached(self, device, app, service):
+        """app is None for unassigned services"""
+
+        self.emit({
+            'event': 'service_attached',
+            'device': self.device_ids.get(device),
+            'app': self.app_ids[app][1] if app in self.app_ids else None,
+            'service': {
+                'name': service.name,
+                'type': service.type
+            }
+        })
+
+    def authorless_service_discovered(self, service):
+        self.activity_keys[service] = ('authorless_service', service.name)
+
+        self.emit({
+            'event': 'authorless_service_discovered',
+            'service': {
+                'name': service.name,
+                'type': service.type
+            }
+        })
+
+        for k, v in service.activity.items():
+            self.activity_changed(service, k, v)
+
+    def authorless_service_promoted(self, service, device, removed):
+        """A stream of service was found to belong to device. If removed, the
+        service has no streams left and is no longer authorless.
+        """
+
+        self.emit({
+            'event': 'authorless_service_promoted',
+            'service': service.name,
+            'device': self.device_ids.get(device),
+            'removed': removed
+        })
+
+        if removed:
+            self.authorless_service_removed(service)
+
+    def authorless_service_removed(self, service):
+        """Activity of service not yet flushed is dropped with it"""
+
+        key = self.activity_keys.pop(service, None)
+        if key is not None:
+            self.pending.pop(key, None)
+
+    def activity_changed(self, entity, time_string, bytes_count):
+        key = self.activity_keys.get(entity)
+        if key is None:
+            # Services of devices are reported inside device activity
+            return
+
+        activity = self.pending.setdefault(key, {})
+        activity[time_string] = activity.get(time_string, 0) + bytes_count
+
+    def tick(self, time):
+        """time is the capture time of last analyzed packet"""
+
+        if self.next_flush is None:
+            self.next_flush = time + self.interval
+
+        elif time >= self.next_flush:
+            self.flush_activity()
+            self.next_flush = time + self.interval
+
+    def flush_activity(self):
+        for (kind, name), activity in self.pending.items():
+            self.emit({'event': 'activity', kind: name, 'activity': activity})
+        self.pending = {}
+
+    def finish(self, environment, summary):
+        """Emits pending activity and then final results, one entity at a time"""
+
+        self.flush_activity()
+
+        for each in environment.devices:
+            self.emit({
+                'event': 'device_report',
+                'device': self.device_ids.get(each),
+                'report': DeviceLess.from_device(each)
+            })
+
+        for each in environment.authorless_services:
+            self.emit({
+                'event': 'authorless_service_report',
+                'report': ServiceLess.from_service(each)
+            })
+
+        self.emit({'event': 'summary', 'summary': summary})
@@ -9,8 +9,9 @@ So 4 pkg will go through TCPHandler and only 1 through HTTPHandler.
 This was taken in account in order to manage correctly the environment.
 """
 
-from models import Device, AuthorlessService, Service
-from constants import Transport
+from models import Device, AuthorlessService, ServiceDescriptor
+from constants import FlowOwner, Transport
+from utils import get_time_bucket
 
 import random
 import streams
@@ -19,21 +20,15 @@ import ipaddress
 
 
 def is_dns_response(pkg):
-    return hasattr(pkg.dns, 'a')
+    return bool(pkg.dns_answers)
 
 
 def is_request(pkg):
-    return hasattr(pkg.http, 'request')
+    return pkg.http_request
 
 
 def get_dns_answers(pkg):
-    ret = []
-    for field_line in pkg.dns._get_all_field_lines():
-        if ':' in field_line:
-            field_name, field_line = field_line.split(':', 1)
-            if (field_name.strip() == 'Address'):
-                ret.append(field_line.strip())
-    return ret
+    return pkg.dns_answers
 
 
 def is_ipaddress(string):
@@ -45,24 +40,27 @@ def is_ipaddress(string):
 
 
 def is_client_hello(pkg):
-    return (hasattr(pkg.ssl, 'record') and
-            pkg.ssl.record.split(': ')[-1] == 'Client Hello')
+    return pkg.tls_client_hello
 
 
 def create_stream_dict(pkg):
-    transport_pkg = pkg.udp if hasattr(pkg, 'udp') else pkg.tcp
     return {
-        'ip_src': pkg.ip.src,
-        'ip_dst': pkg.ip.dst,
-        'port_src': transport_pkg.srcport,
-        'port_dst': transport_pkg.dstport
+        'ip_src': pkg.src_address,
+        'ip_dst': pkg.dst_address,
+        'port_src': pkg.src_port,
+        'port_dst': pkg.dst_port
     }
 
 
 def get_cipher_suite(pkg):
-    l = pkg.ssl._get_all_fields_with_alternates()
-    cipher_suite = [x for x in l if x.name == 'ssl.handshake.ciphersuite']
-    return list(map(lambda x: (x.raw_value, x.showname_value), cipher_suite))
+    return pkg.tls_cipher_suites or []
+
+
+def add_temporal_activity(activity, time, length):
+    """Activity of temporal streams is kept by second, as in ActivityDataManager"""
+
+    time_string = get_time_bucket(time)
+    activity[time_string] = activity.get(time_string, 0) + length
 
 
 def get_significant_name_from_url(url):
@@ -96,7 +94,8 @@ class Handler(object):
         self.environment = environment
 
     def search_service(self, pkg):
-        """This method will return a Service that is involved with that pkg.
+        """This method will return descriptor of the Service that is involved with
+        that pkg, with the address or the host it was found by, or None.
         
         Priority to search:
             1) From destiny IP. For example 50.22.198.206 -> WhatsApp
@@ -106,36 +105,34 @@ class Handler(object):
                 2.3) Name from URL
 
         """
-        service = self.environment.service_analyzer.find_service_from_ip(
-            pkg.ip.dst)
-        if service:
-            service.ips.add(pkg.ip.dst)
-            return service
+        address = pkg.dst_address
+        descriptor = self.environment.service_analyzer.find_service_from_ip(
+            address)
+        if descriptor:
+            return descriptor, address, None
         else:
-            host = self.environment.find_host(pkg.ip.dst)
+            host = self.environment.find_host(address, pkg.timestamp)
             if host:
-                name = get_significant_name_from_url(host)
-                ret_service = self.environment.service_analyzer.find_service_from_absolute_url(
+                descriptor = self.environment.service_analyzer.find_service_from_absolute_url(
                     host
                 ) or self.environment.service_analyzer.find_service_from_url(
-                    host) or Service.from_name(name)
+                    host) or ServiceDescriptor.from_name(
+                        get_significant_name_from_url(host))
 
-                ret_service.hosts.add(host)
-                return ret_service
+                return descriptor, None, host
             else:
                 return None
 
 
 class DNSHandler(Handler):
-    """This handler only saves answers to cache (address_host map)"""
+    """This handler only saves answers to cache (host_cache)"""
 
     def process(self, pkg):
         if self.needs_processing(pkg):
             answers = get_dns_answers(pkg)
             for each in answers:
-                if each not in self.environment.address_host:
-                    self.environment.address_host[each] = []
-                self.environment.address_host[each].append(pkg.dns.qry_name)
+                self.environment.host_cache.add(each, pkg.dns_query,
+                                                pkg.timestamp, pkg.dns_ttl)
 
     def needs_processing(self, pkg):
         return is_dns_response(pkg)
@@ -144,122 +141,113 @@ class DNSHandler(Handler):
 class TransportHandler(Handler):
     """This handler analyzes TCP and UDP packages."""
 
-    def process(self, pkg):
+    def process(self, pkg, flow):
+        """flow is the entry of pkg stream in the flow table, if any"""
 
-        if self.needs_processing(pkg):
+        if flow is None:
             self.process_new_stream(pkg)
 
         else:
-            self.process_existing_stream(pkg)
+            self.process_existing_stream(pkg, flow)
 
-    def process_existing_stream(self, pkg):
+    def process_existing_stream(self, pkg, flow):
         """This pkg corresponds to some Service or Device
         All correspondence is done using pkg stream number.
         """
 
-        time, length = pkg.sniff_time, pkg.length
+        time, length = pkg.timestamp, pkg.length
 
-        stream = self.get_stream(pkg)
+        stream = pkg.stream
 
-        if self.environment.has_device_from_stream(pkg):
+        if flow.owner is FlowOwner.DEVICE:
             # This pkg is from one device and (possibly) one app of that device
 
-            device = self.environment.locate_device(pkg)
+            device = flow.target
             device.add_activity(time, length)
 
             service = device.get_service_from_stream(stream)
             if service:
                 service.add_activity(time, length)
 
-        elif self.environment.has_service_from_stream(pkg):
+        elif flow.owner is FlowOwner.SERVICE:
             # This pkg is from one service.
             # It can be a potential authorless service or will be later associated with device
 
-            service = self.environment.locate_service(pkg)
+            service = flow.target
             service.add_activity(time, length)
-            service.add_activity_to_stream(self.get_protocol(), stream, time,
+            service.add_activity_to_stream(pkg.transport, stream, time,
                                            length)
 
-        elif self.environment.has_temporal_stream(pkg):
-            # Mantain cached currently unasigned streams
-            self.environment.temporal_stream_map[self.get_protocol()][
-                stream].append((time, length))
+        else:
+            # Mantain activity of currently unasigned streams
+            add_temporal_activity(flow.target, time, length)
 
     def process_new_stream(self, pkg):
         """From TCP or UDP pkg can only appear services.
         Devices appear only from HTTP requests.
         """
 
-        service = self.search_service(pkg)
+        found = self.search_service(pkg)
 
-        if service:
+        if found:
             # It can be an existing service that involves new stream
-            self.process_new_detected_service(service, pkg)
+            self.process_new_detected_service(pkg, *found)
 
         else:
-            # If no service can be associated, its activity is saved in temporal map
-            self.environment.temporal_stream_map[self.get_protocol()][
-                self.get_stream(pkg)] = [(pkg.sniff_time, pkg.length)]
+            # If no service can be associated, its activity is saved in temporal flow
+            activity = {}
+            add_temporal_activity(activity, pkg.timestamp, pkg.length)
+            self.environment.assign_flow(pkg, FlowOwner.TEMPORAL, activity)
 
-    def process_new_detected_service(self, candidate_service, pkg):
+    def process_new_detected_service(self, pkg, descriptor, address, host):
         """Checks if this Service from pkg corresponds to existing Service (that involved new stream, for example WhatsApp)
-        or to new Service. 
+        or to new Service. address and host are the ones the Service was found by, if any.
 
         There is no need to merge possible temporal former packages as never unasigned TCP pkg can become later AuthorlessService.
         Temporary streams can become only HTTP packages.
         """
 
-        name = candidate_service.name
-
-        if self.environment.already_exists_authorless_service(name):
-            service = self.environment.get_existing_authorless_service(name)
+        service = self.environment.get_existing_authorless_service(
+            descriptor.name)
 
-            # updated with new possible ips and hosts
-            service.hosts.update(candidate_service.hosts)
-            service.ips.update(candidate_service.ips)
-
-        else:
+        if not service:
             # for now, if no existing service is found, it's an AuthorlessService
-            service = AuthorlessService.from_service(candidate_service)
+            service = AuthorlessService(descriptor)
 
-            # If found service by name and not by IP, candidate_service does not contain IP.
+            # If found service by name and not by IP, address is None.
             # In this case, add IP only if its public
-            if not ipaddress.ip_address(pkg.ip.dst).is_private:
-                service.ips.add(pkg.ip.dst)
+            if not ipaddress.ip_address(pkg.dst_address).is_private:
+                service.ips.add(pkg.dst_address)
 
-            self.environment.authorless_services.append(service)
+            self.environment.authorless_services.add(service)
+            self.environment.reporter.authorless_service_discovered(service)
 
-        time, length = pkg.sniff_time, pkg.length
+        # updated with new possible ips and hosts
+        if address:
+            service.ips.add(address)
+        if host:
+            service.hosts.add(host)
 
-        stream = self.get_stream(pkg)
-        protocol = self.get_protocol()
+        time, length = pkg.timestamp, pkg.length
+
+        stream = pkg.stream
+        protocol = pkg.transport
 
         service.add_activity(time, length)
 
         # Add stream to current service. This will be useful if later this stream is associated with device
         service.add_activity_to_stream(protocol, stream, time, length)
 
-        # Add stream to service map
-        self.environment.service_stream_map[protocol][stream] = service
-
-    def needs_processing(self, pkg):
-        return not self.environment.previously_analized_stream(pkg)
+        # Attribute stream to service
+        self.environment.assign_flow(pkg, FlowOwner.SERVICE, service)
 
 
 class UDPHandler(TransportHandler):
-    def get_stream(self, pkg):
-        return pkg.udp.stream
-
-    def get_protocol(self):
-        return Transport.UDP
+    pass
 
 
 class TCPHandler(TransportHandler):
-    def get_stream(self, pkg):
-        return pkg.tcp.stream
-
-    def get_protocol(self):
-        return Transport.TCP
+    pass
 
 
 class HTTPHandler(Handler):
@@ -268,6 +256,14 @@ class HTTPHandler(Handler):
     Remember that HTTP pkg is the last one that completes the TCP collection.
     """
 
+    def __init__(self, environment):
+        super().__init__(environment)
+
+        # User agent arguments to device solved for them. Only valid while
+        # devices do not change, see Environment.devices_version
+        self.device_memo = {}
+        self.memo_version = None
+
     def search_service(self, pkg):
         """For HTTP, a service if not found by conventional method,
         the 'host' header can be used to determine destiny URL.
@@ -275,38 +271,36 @@ class HTTPHandler(Handler):
         The Service from 'host' header is searched the same way as a DNS cache answered.
         """
 
-        service = super().search_service(pkg)
+        found = super().search_service(pkg)
 
-        if service:
-            return service
+        if found:
+            return found
 
-        if hasattr(pkg.http, 'host'):
+        host = pkg.http_host
+        if host:
             # When header host is IP addr, create service 'Unknown (IP)'. 
             # If not, service will have name of the IP
             # The name must have info of the IP for the equals btw services
-            if is_ipaddress(pkg.http.host):
-                return Service.from_ip_only(pkg.http.host)
+            if is_ipaddress(host):
+                return ServiceDescriptor.from_ip_only(host), None, None
             else:
-                name = get_significant_name_from_url(pkg.http.host)
-                service = self.environment.service_analyzer.find_service_from_absolute_url(
-                    pkg.http.host
+                descriptor = self.environment.service_analyzer.find_service_from_absolute_url(
+                    host
                 ) or self.environment.service_analyzer.find_service_from_url(
-                    pkg.http.host) or Service.from_name(name)
-                service.hosts.add(pkg.http.host)
-                return service
+                    host) or ServiceDescriptor.from_name(
+                        get_significant_name_from_url(host))
+                return descriptor, None, host
         else:
             return None
 
-    def process(self, pkg):
+    def process(self, pkg, flow):
         """pkg can be from existing device or can have been originated from new device"""
 
-        if self.environment.has_device_from_stream(pkg):
-
-            device = self.environment.locate_device(pkg)
-            self.process_existing_stream(pkg, device)
+        if flow is not None and flow.owner is FlowOwner.DEVICE:
+            self.process_existing_stream(pkg, flow.target)
 
         else:
-            self.process_new_stream(pkg)
+            self.process_new_stream(pkg, flow)
 
     def process_existing_stream(self, pkg, device):
         """If it was a request and has user agent, it can update device and app characteristics
@@ -314,44 +308,39 @@ class HTTPHandler(Handler):
         """
 
         def action(device_args, app_args):
-            device.update(device_args, app_args, pkg.tcp.stream)
+            self.environment.update_device(device, device_args, app_args,
+                                           pkg.stream)
 
-        if hasattr(pkg.http, 'user_agent'):
-            user_agent = pkg.http.user_agent
-            self.process_user_agent(user_agent, action)
+        if pkg.http_user_agent:
+            self.process_user_agent(pkg.http_user_agent, action)
 
-        time, length = pkg.sniff_time, pkg.length
+        time, length = pkg.timestamp, pkg.length
         device.add_activity(time, length)
 
-        service = device.get_service_from_stream(pkg.tcp.stream)
+        service = device.get_service_from_stream(pkg.stream)
         if service:
             service.add_activity(time, length)
 
-    def merge_temporal_stream(self, device, pkg):
-        """Adds activity and remove from temporal map former TCP packages that conformed HTTP request"""
-
-        for each in self.environment.locate_temporal(pkg):
-            device.add_activity(each[0], each[1])
-            service = device.get_service_from_stream(pkg.tcp.stream)
-            if service:
-                service.add_activity(each[0], each[1])
+    def merge_temporal_stream(self, device, pkg, activity):
+        """Adds activity of former TCP packages that conformed HTTP request"""
 
-        del self.environment.temporal_stream_map[Transport.TCP][pkg.tcp.stream]
+        device.merge_activity(activity)
+        service = device.get_service_from_stream(pkg.stream)
+        if service:
+            service.merge_activity(activity)
 
-    def merge_authorless_service(self, device, pkg):
+    def merge_authorless_service(self, device, pkg, existing_service):
         """This method needs to add AuthorlessService activity to Device and Service.
         
         This device will always contain this AuthorlessService, as an App Service or an unasigned Service.
         This is because the service es searched (and added to the device) the same way the AuthorlessService was (plus host match).
         So, there is no chance that an AuthorlessService was detected but not the same service for this device
         """
-        existing_service = self.environment.locate_service(pkg)
-
         activity_from_stream = existing_service.activity_per_stream[
-            Transport.TCP][pkg.tcp.stream]
+            Transport.TCP][pkg.stream]
 
         device.merge_activity(activity_from_stream)
-        service = device.get_service_from_stream(pkg.tcp.stream)
+        service = device.get_service_from_stream(pkg.stream)
         if service:
             service.merge_activity(activity_from_stream)
 
@@ -360,67 +349,90 @@ class HTTPHandler(Handler):
         # by other devices also (think WhatsApp)
 
         existing_service.remove_activity_from_stream(Transport.TCP,
-                                                     pkg.tcp.stream)
-
-        del self.environment.service_stream_map[Transport.TCP][pkg.tcp.stream]
+                                                     pkg.stream)
 
         # Only remove authorless Service
         # if no streams are left associated with it
-        if existing_service.is_empty():
+        removed = existing_service.is_empty()
+        if removed:
             self.environment.authorless_services.remove(existing_service)
 
-    def process_new_stream(self, pkg):
-        """New stream can come from new Device or from existing Device."""
+        self.environment.reporter.authorless_service_promoted(
+            existing_service, device, removed)
+
+    def process_new_stream(self, pkg, flow):
+        """New stream can come from new Device or from existing Device.
+
+        flow is the entry of the stream if it was temporal or attributed to an
+        authorless service.
+        """
 
         def action(device_args, app_args):
+            # Before the stream is attributed to the device
+            previous_owner = flow.owner if flow else None
+            previous_target = flow.target if flow else None
 
             # Locate device. It can be new device or existing once
             device = self.solve_device(device_args, app_args)
 
             # Here, a new App could have been and linked to that stream
-            device.update(device_args, app_args, pkg.tcp.stream)
+            self.environment.update_device(device, device_args, app_args,
+                                           pkg.stream)
+
+            self.environment.assign_flow(pkg, FlowOwner.DEVICE, device)
 
-            self.environment.device_stream_map[Transport.TCP][
-                pkg.tcp.stream] = device
+            device.add_activity(pkg.timestamp, pkg.length)
 
-            device.add_activity(pkg.sniff_time, pkg.length)
+            app = device.stream_to_app.get(pkg.stream)
 
-            app = device.stream_to_app.get(pkg.tcp.stream)
+            found = self.search_service(pkg)
+            if app and found:
+                descriptor, _, host = found
 
-            service = self.search_service(pkg)
-            if app and service:
                 # If app is a new app, a new service can be associated with it.
+                attached = descriptor.name not in app.services
                 incorporated_service = app.process_service_from_new_stream(
-                    service, pkg.sniff_time, pkg.length, pkg.tcp.stream)
+                    descriptor, pkg.timestamp, pkg.length, pkg.stream)
+                if attached:
+                    if host:
+                        incorporated_service.hosts.add(host)
+                    self.environment.reporter.service_attached(
+                        device, app, incorporated_service)
 
                 # Add possible new ips and hosts
-                incorporated_service.ips.add(pkg.ip.dst)
-                if hasattr(pkg.http,
-                           'host') and not is_ipaddress(pkg.http.host):
-                    incorporated_service.hosts.add(pkg.http.host)
+                incorporated_service.ips.add(pkg.dst_address)
+                if pkg.http_host and not is_ipaddress(pkg.http_host):
+                    incorporated_service.hosts.add(pkg.http_host)
+
+            elif found:
+                descriptor, _, host = found
 
-            elif service:
                 # If no app is associated and it's a service, then is an unasigned service.
+                attached = descriptor.name not in device.unasigned_services
                 incorporated_service = device.process_unasigned_service_from_new_stream(
-                    service, pkg.sniff_time, pkg.length, pkg.tcp.stream)
+                    descriptor, pkg.timestamp, pkg.length, pkg.stream)
+                if attached:
+                    if host:
+                        incorporated_service.hosts.add(host)
+                    self.environment.reporter.service_attached(
+                        device, None, incorporated_service)
 
                 # Add possible new ips and hosts
-                incorporated_service.ips.add(pkg.ip.dst)
-                if hasattr(pkg.http, 'host'):
-                    incorporated_service.hosts.add(pkg.http.host)
+                incorporated_service.ips.add(pkg.dst_address)
+                if pkg.http_host:
+                    incorporated_service.hosts.add(pkg.http_host)
 
-            if self.environment.has_temporal_stream(pkg):
+            if previous_owner is FlowOwner.TEMPORAL:
                 # This will associate to this device former TCP packages
                 # that conformed the HTTP package but that were currently unasigned
-                self.merge_temporal_stream(device, pkg)
+                self.merge_temporal_stream(device, pkg, previous_target)
 
-            if self.environment.has_service_from_stream(pkg):
+            elif previous_owner is FlowOwner.SERVICE:
                 # An Authorless Service was not Authorless
-                self.merge_authorless_service(device, pkg)
+                self.merge_authorless_service(device, pkg, previous_target)
 
-        if is_request(pkg) and hasattr(pkg.http, 'user_agent'):
-            user_agent = pkg.http.user_agent
-            self.process_user_agent(user_agent, action)
+        if is_request(pkg) and pkg.http_user_agent:
+            self.process_user_agent(pkg.http_user_agent, action)
 
     def process_user_agent(self, user_agent, action):
 
@@ -435,9 +447,27 @@ class HTTPHandler(Handler):
     def solve_device(self, device_args, app_args):
         """ Returns best matching device or a new one created (and added to environment)"""
 
+        if self.memo_version != self.environment.devices_version:
+            self.device_memo.clear()
+            self.memo_version = self.environment.devices_version
+
+        key = (tuple(sorted(device_args.items())),
+               tuple(sorted(app_args.items())))
+
+        device = self.device_memo.get(key)
+        if device is None:
+            device = self.find_device(device_args, app_args)
+            self.device_memo[key] = device
+
+        return device
+
+    def find_device(self, device_args, app_args):
+        """Only devices that can have positive score are scored. See DeviceIndex"""
+
         devices = []
         max_score = 0
-        for d in self.environment.devices:
+        for d in self.environment.device_index.candidates(device_args,
+                                                          app_args):
             score = d.match_score(device_args, app_args)
             if max_score > 0 and score == max_score:
                 devices.append(d)
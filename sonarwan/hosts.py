@@ -0,0 +1,78 @@
+"""
+Cache of DNS answers, used to find the host name of addresses seen in streams.
+
+Names are kept once per address together with the capture time their answer
+expires, as told by its TTL. The cache is bounded: when full, the least
+recently used address is evicted.
+"""
+
+from collections import OrderedDict
+
+from tools.cache import LRUCache
+
+# Addresses kept by default
+DEFAULT_CAPACITY = 65536
+
+
+class HostCache(LRUCache):
+    """Maps addresses to the names they were answered for.
+
+    Entries are {name: capture time its answer expires}. Expiration is None
+    when TTL of the answer is unknown.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        super().__init__(capacity)
+
+    def add(self, address, name, time, ttl):
+        """name was answered for address at capture time, valid for ttl seconds"""
+
+        self.add_expiration(address, name,
+                            time + ttl if ttl is not None else None)
+
+    def add_expiration(self, address, name, expiration):
+        names = self.entries.get(address)
+
+        if names is None:
+            self.put(address, {name: expiration})
+            return
+
+        self.entries.move_to_end(address)
+
+        if name not in names:
+            names[name] = expiration
+        elif names[name] is not None:
+            names[name] = None if expiration is None else max(
+                names[name], expiration)
+
+    def find(self, address, time):
+        """Names of address whose answers had not expired at capture time.
+        Returns None if there is none.
+        """
+
+        names = self.entries.get(address)
+
+        if names is not None:
+            expired = [
+                k for k, v in names.items() if v is not None and v < time
+            ]
+            for each in expired:
+                del names[each]
+
+            if not names:
+                del self.entries[address]
+
+        return self.get(address)
+
+    def merge(self, other):
+        """Adds answers and counters of the cache of another Environment"""
+
+        for address, names in other.entries.items():
+            for name, expiration in names.items():
+                self.add_expiration(address, name, expiration)
+
+        self.add_stats(other.get_stats())
+
+    def clear(self):
+        """Forgets every answer. Counters are kept"""
+        self.entries = OrderedDict()
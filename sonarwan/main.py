@@ -6,11 +6,27 @@ from logger import logger
 def main():
     parser = Arguments.create_parser()
     args = parser.parse_args()
+    if not args.files and not args.interface:
+        parser.error('capture files or an interface are required')
+    if args.interface and args.checkpoint:
+        parser.error('--checkpoint works only with capture files')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+
     arguments = Arguments(args.json, args.patterns, args.inference,
-                          args.services, args.progress, args.output)
+                          args.services, args.progress, args.output,
+                          args.backend, args.display_filter, args.jobs,
+                          args.shards, args.interface, args.report_interval,
+                          args.idle_timeout, args.activity_retention,
+                          args.ndjson, args.events_interval, args.checkpoint,
+                          args.checkpoint_interval, args.resume,
+                          args.tools_database, args.lookup_cache_size)
 
     sonarwan = SonarWan(arguments)
-    sonarwan.run(args.files)
+    if args.interface:
+        sonarwan.run_live(args.interface)
+    else:
+        sonarwan.run(args.files)
     sonarwan.print_info()
     logger.info('SonarWAN ended succesfully')
 
@@ -1,7 +1,8 @@
 import csv
 import random
+import weakref
 from constants import Transport
-from utils import sort_by_value
+from utils import sort_by_value, get_time_bucket
 
 
 def merge_dicts(base, to_merge, operation):
@@ -22,6 +23,22 @@ def unmerge_dicts(base, to_unmerge, operation):
             base[k] = operation(base[k], v)
 
 
+def merge_services(services, to_merge):
+    """Merge to_merge services in services ServiceCollection. Services with same name are the same.
+    Returns services added to services.
+    """
+
+    added = []
+    for each in to_merge:
+        existing = services.get(each.name)
+        if existing:
+            existing.merge(each)
+        else:
+            services.add(each)
+            added.append(each)
+    return added
+
+
 def similarity(base, k, v):
     if k in base:
         compare_value = base[k]
@@ -41,10 +58,16 @@ def similarity(base, k, v):
 class ActivityDataManager(object):
     """Contains only utils classes to manage activity"""
 
+    # Notified of every change of activity, with the bucket and the bytes added
+    # (negative if removed). See events.Reporter
+    listener = None
+
     def add_activity(self, time, bytes_count):
-        time_string = time.replace(microsecond=0).isoformat()
+        time_string = get_time_bucket(time)
         self.activity[time_string] = self.activity.get(time_string,
-                                                       0) + int(bytes_count)
+                                                       0) + bytes_count
+        if self.listener:
+            self.listener.activity_changed(self, time_string, bytes_count)
 
     def merge_activity(self, other_activity):
         def sum_fn(v1, v2):
@@ -52,6 +75,56 @@ class ActivityDataManager(object):
 
         merge_dicts(self.activity, other_activity, sum_fn)
 
+        if self.listener:
+            for k, v in other_activity.items():
+                self.listener.activity_changed(self, k, v)
+
+    def drop_activity_before(self, time_string):
+        """Removes activity of seconds before time_string (as returned by get_time_bucket)"""
+
+        old = [k for k in self.activity if k < time_string]
+        for each in old:
+            del self.activity[each]
+
+
+class ServiceCollection(object):
+    """Services in insertion order, indexed by name.
+    
+    Services are the same if they have same name, so there is at most one
+    service for each name. Lookup, insertion and removal are constant time.
+    """
+
+    def __init__(self, services=()):
+        self.by_name = {}
+        for each in services:
+            self.add(each)
+
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def add(self, service):
+        self.by_name[service.name] = service
+
+    def remove(self, service):
+        del self.by_name[service.name]
+
+    def sort_by_size(self):
+        """Bigger services first"""
+
+        services = sorted(
+            self.by_name.values(), key=lambda each: each.get_size(),
+            reverse=True)
+        self.by_name = {each.name: each for each in services}
+
 
 class App(object):
     """An App is a container of services. An App corresponds to one device.
@@ -64,7 +137,7 @@ class App(object):
     def __init__(self):
 
         self.characteristics = {}
-        self.services = []
+        self.services = ServiceCollection()
 
         # Maps every stream to a service to have fast access
         self.stream_to_service = {}
@@ -73,7 +146,11 @@ class App(object):
         return sum(each.get_size() for each in self.services)
 
     def update_app(self, app_args):
-        """Add new characteristics and updates them if new characteristic is longer than current"""
+        """Add new characteristics and updates them if new characteristic is longer than current.
+        Returns True if any characteristic changed
+        """
+
+        changed = False
 
         for k in app_args:
             current_value = self.characteristics.get(k)
@@ -81,26 +158,23 @@ class App(object):
 
             if (not current_value) or (new_value and
                                        len(new_value) > len(current_value)):
+                changed = changed or current_value != new_value
                 self.characteristics[k] = new_value
 
-    def process_service_from_new_stream(self, service, time, length,
+        return changed
+
+    def process_service_from_new_stream(self, descriptor, time, length,
                                         stream_number):
         """It can create a new service or find an existing one that matches.
         It links the stream to the service
 
         If new Service is created, it is added to App services
         """
-        existing = False
-        curr_service = service
-
-        for each in self.services:
-            if each.name == service.name:
-                existing = True
-                curr_service = each
-                break
+        curr_service = self.services.get(descriptor.name)
 
-        if not existing:
-            self.services.append(curr_service)
+        if not curr_service:
+            curr_service = Service(descriptor)
+            self.services.add(curr_service)
 
         curr_service.add_activity(time, length)
         self.stream_to_service[stream_number] = curr_service
@@ -108,11 +182,54 @@ class App(object):
         return curr_service
 
     def sort_services(self):
-        s_map = {}
-        for each_service in self.services:
-            s_map[each_service] = each_service.get_size()
+        self.services.sort_by_size()
+
+
+class ServiceDescriptor(object):
+    """Name and type of a Service.
+
+    Descriptors are immutable and interned: every lookup of the same service
+    gets the same instance, and a Service (with its activity) is only built
+    when it is attached to an App, a Device or as an AuthorlessService.
+    """
+
+    __slots__ = ('name', 'type', '__weakref__')
+
+    # (name, type) to descriptor, while some Service or tool uses it
+    interned = weakref.WeakValueDictionary()
 
-        sort_by_value(self.services, s_map)
+    def __new__(cls, name, type_param):
+        key = (name, type_param)
+        descriptor = cls.interned.get(key)
+
+        if descriptor is None:
+            descriptor = super().__new__(cls)
+            object.__setattr__(descriptor, 'name', name)
+            object.__setattr__(descriptor, 'type', type_param)
+            cls.interned[key] = descriptor
+
+        return descriptor
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ServiceDescriptor is immutable')
+
+    def __reduce__(self):
+        # Interned again when unpickled
+        return (ServiceDescriptor, (self.name, self.type))
+
+    @classmethod
+    def from_characteristics(cls, characteristics):
+        return cls(
+            characteristics.get('name') or 'Unknown',
+            characteristics.get('type') or 'Unknown')
+
+    @classmethod
+    def from_name(cls, name):
+        return cls(name, 'Generic')
+
+    @classmethod
+    def from_ip_only(cls, ip):
+        return cls('Unknown (IP {})'.format(ip), 'Generic')
 
 
 class Service(ActivityDataManager):
@@ -135,47 +252,30 @@ class Service(ActivityDataManager):
     Services are the same if they have same name
     """
 
-    def __init__(self):
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
         self.activity = {}
-        self.name = None
-        self.type = None
         self.ips = set()
         self.hosts = set()
 
-    @classmethod
-    def from_characteristics(cls, characteristics):
-        service = cls()
-        service.name = characteristics.get('name') or 'Unknown'
-        service.type = characteristics.get('type') or 'Unknown'
-        return service
-
-    @classmethod
-    def from_service(cls, p_service):
-        service = cls()
-        service.name = p_service.name
-        service.type = p_service.type
-        service.activity = p_service.activity
-        service.ips = p_service.ips
-        service.hosts = p_service.hosts
-        return service
-
-    @classmethod
-    def from_name(cls, name):
-        service = cls()
-        service.name = name
-        service.type = 'Generic'
-        return service
+    @property
+    def name(self):
+        return self.descriptor.name
 
-    @classmethod
-    def from_ip_only(cls, ip):
-        service = cls()
-        service.name = 'Unknown (IP {})'.format(ip)
-        service.type = 'Generic'
-        return service
+    @property
+    def type(self):
+        return self.descriptor.type
 
     def get_size(self):
         return sum([v for k, v in self.activity.items()])
 
+    def merge(self, other):
+        """Adds activity, ips and hosts of other Service with same name"""
+
+        self.merge_activity(other.activity)
+        self.ips.update(other.ips)
+        self.hosts.update(other.hosts)
+
 
 class AuthorlessService(Service):
     """An Authorless Service is a Service that has no App (and no Device) associated
@@ -187,8 +287,8 @@ class AuthorlessService(Service):
         - HTTP traffic with no information about the device
     """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, descriptor):
+        super().__init__(descriptor)
 
         # This services can have multiple streams from different devices
         # that are consuming this service. For example WhatsApp can be 
@@ -197,31 +297,64 @@ class AuthorlessService(Service):
         self.activity_per_stream = {Transport.UDP: {}, Transport.TCP: {}}
 
     def add_activity_to_stream(self, protocol, stream, time, bytes_count):
-        time_string = time.replace(microsecond=0).isoformat()
+        time_string = get_time_bucket(time)
 
         if stream not in self.activity_per_stream[protocol]:
             self.activity_per_stream[protocol][stream] = {}
 
         self.activity_per_stream[protocol][stream][
             time_string] = self.activity_per_stream[protocol][stream].get(
-                time_string, 0) + int(bytes_count)
+                time_string, 0) + bytes_count
 
     def remove_activity_from_stream(self, protocol, stream):
         def substract_fn(v1, v2):
             return v1 - v2
 
-        unmerge_dicts(self.activity,
-                      self.activity_per_stream[protocol][stream], substract_fn)
+        activity = self.activity_per_stream[protocol][stream]
+        unmerge_dicts(self.activity, activity, substract_fn)
+
+        if self.listener:
+            for k, v in activity.items():
+                if k in self.activity:
+                    self.listener.activity_changed(self, k, -v)
+
         del self.activity_per_stream[protocol][stream]
 
+    def merge(self, other):
+        super().merge(other)
+
+        def sum_fn(v1, v2):
+            return v1 + v2
+
+        for protocol, streams in other.activity_per_stream.items():
+            for stream, activity in streams.items():
+                merge_dicts(self.activity_per_stream[protocol].setdefault(
+                    stream, {}), activity, sum_fn)
+
+    def forget_stream(self, protocol, stream):
+        """Stream will not be seen again. Its activity is kept in service activity"""
+        self.activity_per_stream[protocol].pop(stream, None)
+
+    def drop_activity_before(self, time_string):
+        super().drop_activity_before(time_string)
+
+        for streams in self.activity_per_stream.values():
+            for activity in streams.values():
+                old = [k for k in activity if k < time_string]
+                for each in old:
+                    del activity[each]
+
     def is_empty(self):
-        """Return True if it has no more streams left. 
-        This occures when all streams could be assigned to an App (and a Device)
+        """Return True if it has no more streams left nor activity.
+        This occures when all streams could be assigned to an App (and a Device).
+
+        Activity of forgotten streams stays in the service, as it was never
+        assigned to any Device.
         """
 
         return self.activity_per_stream[
             Transport.TCP] == {} and self.activity_per_stream[
-                Transport.UDP] == {}
+                Transport.UDP] == {} and not any(self.activity.values())
 
 
 class Device(ActivityDataManager):
@@ -241,8 +374,8 @@ class Device(ActivityDataManager):
         self.characteristics = {}
         self.activity = {}
 
-        # List of services that are not associated with App
-        self.unasigned_services = []
+        # Services that are not associated with App
+        self.unasigned_services = ServiceCollection()
         self.stream_to_unasigned_service = {}
 
         # For the app (and later the service) can be obtained with stream number
@@ -250,6 +383,17 @@ class Device(ActivityDataManager):
 
         self.inference_engine = inference_engine
 
+        # Incremented every time characteristics of device or its apps change
+        self.revision = 0
+
+    def __getstate__(self):
+        """The inference engine is shared by all devices, so it is not pickled.
+        It must be set again after unpickling.
+        """
+        state = self.__dict__.copy()
+        del state['inference_engine']
+        return state
+
     def get_size(self):
         return sum(e.get_size()
                    for e in self.apps) + sum(e.get_size()
@@ -264,11 +408,7 @@ class Device(ActivityDataManager):
         sort_by_value(self.apps, app_map)
 
     def sort_unassigned_services(self):
-        us_map = {}
-        for each_service in self.unasigned_services:
-            us_map[each_service] = each_service.get_size()
-
-        sort_by_value(self.unasigned_services, us_map)
+        self.unasigned_services.sort_by_size()
 
     def match_score(self, device_args, app_args):
         """Based on device and app dictionary of characteristics it returns a score of correspondence
@@ -293,6 +433,64 @@ class Device(ActivityDataManager):
 
         return score
 
+    def drop_activity_before(self, time_string):
+        """Also drops activity of services of this device"""
+
+        super().drop_activity_before(time_string)
+
+        for app in self.apps:
+            for each in app.services:
+                each.drop_activity_before(time_string)
+
+        for each in self.unasigned_services:
+            each.drop_activity_before(time_string)
+
+    def forget_stream(self, stream_number):
+        """Stream will not be seen again, so links to its app and service are removed"""
+
+        app = self.stream_to_app.pop(stream_number, None)
+        if app:
+            app.stream_to_service.pop(stream_number, None)
+        self.stream_to_unasigned_service.pop(stream_number, None)
+
+    def merge_score(self, other):
+        """Score of correspondence with a Device detected by another Environment.
+        
+        It returns -1 if they are incompatible
+        """
+
+        score = self.match_score(other.characteristics, {})
+        if score == -1:
+            return -1
+
+        for app in other.apps:
+            score += self.match_score({}, app.characteristics)
+
+        return score
+
+    def merge(self, other):
+        """Merges a Device detected by another Environment that matches this one.
+        Apps are merged with best matching App and services by name.
+
+        Returns (app, service) of every service attached to this device, app
+        being None for unassigned services.
+        """
+
+        self.update_device(other.characteristics)
+        self.merge_activity(other.activity)
+
+        attached = []
+        for each in other.apps:
+            app = self.update_apps(each.characteristics)
+            attached.extend((app, service)
+                            for service in merge_services(app.services,
+                                                          each.services))
+
+        attached.extend((None, service) for service in merge_services(
+            self.unasigned_services, other.unasigned_services))
+
+        return attached
+
     def update(self, device_args, app_args, stream_number):
         """Updates only characteristics of Device and, in some cases, corresponding App"""
 
@@ -335,8 +533,10 @@ class Device(ActivityDataManager):
         elif app_args:
             app = App()
             self.apps.append(app)
+            self.revision += 1
 
-        app.update_app(app_args)
+        if app.update_app(app_args):
+            self.revision += 1
 
         return app
 
@@ -345,37 +545,39 @@ class Device(ActivityDataManager):
         After that, it checks if it can infer new characteristics with the inference_engine
         """
 
+        changed = False
+
         for k in device_args:
             current_value = self.characteristics.get(k)
             new_value = device_args.get(k)
 
             if (not current_value) or (new_value and
                                        len(new_value) > len(current_value)):
+                changed = changed or current_value != new_value
                 self.characteristics[k] = new_value
 
         inferences = self.inference_engine.analyze_inference(
             self.characteristics)
         if inferences:
+            for k, v in inferences.items():
+                changed = changed or self.characteristics.get(k) != v
             self.characteristics.update(inferences)
 
-    def process_unasigned_service_from_new_stream(self, service, time, length,
-                                                  stream_number):
+        if changed:
+            self.revision += 1
+
+    def process_unasigned_service_from_new_stream(self, descriptor, time,
+                                                  length, stream_number):
         """It can create a new service or find an existing one that matches.
         It links the stream to the service
 
         If new Service is created, it is added to unasigned services
         """
-        existing = False
-        curr_service = service
-
-        for each in self.unasigned_services:
-            if each.name == service.name:
-                existing = True
-                curr_service = each
-                break
+        curr_service = self.unasigned_services.get(descriptor.name)
 
-        if not existing:
-            self.unasigned_services.append(curr_service)
+        if not curr_service:
+            curr_service = Service(descriptor)
+            self.unasigned_services.add(curr_service)
 
         curr_service.add_activity(time, length)
         self.stream_to_unasigned_service[stream_number] = curr_service
@@ -395,6 +597,66 @@ class Device(ActivityDataManager):
             return unasigned_service
 
 
+def index_key(name, value):
+    """Key of a characteristic in DeviceIndex. Characteristics with same name
+    have positive similarity only if their first characters are compatible
+    """
+
+    first = value[0]
+    return name, first.upper() if first.isalnum() else None
+
+
+class DeviceIndex(object):
+    """Inverted index of devices by characteristics of them and their apps.
+
+    A device can only have positive match_score for some arguments if one of
+    its characteristics, or of its apps, has the same name and a compatible
+    first character as one argument. So only devices found by those keys
+    need to be scored.
+    """
+
+    def __init__(self):
+        self.by_device_characteristic = {}
+        self.by_app_characteristic = {}
+
+        # Candidates are returned in the order devices were indexed
+        self.order = {}
+
+    def add(self, device):
+        """Indexes current characteristics of device. Keys of former values
+        are not removed, so candidates can include devices that no longer match.
+        """
+
+        self.order.setdefault(device, len(self.order))
+
+        for k, v in device.characteristics.items():
+            if v:
+                self.by_device_characteristic.setdefault(
+                    index_key(k, v), set()).add(device)
+
+        for app in device.apps:
+            for k, v in app.characteristics.items():
+                if v:
+                    self.by_app_characteristic.setdefault(
+                        index_key(k, v), set()).add(device)
+
+    def candidates(self, device_args, app_args):
+        """Devices that can have positive match_score"""
+
+        found = set()
+
+        for k, v in device_args.items():
+            if v:
+                found.update(
+                    self.by_device_characteristic.get(index_key(k, v), ()))
+
+        for k, v in app_args.items():
+            if v:
+                found.update(self.by_app_characteristic.get(index_key(k, v), ()))
+
+        return sorted(found, key=self.order.get)
+
+
 class DeviceLess():
     """Used for JSON output"""
 
@@ -404,6 +666,16 @@ class DeviceLess():
         self.characteristics = characteristics
         self.activity = activity
 
+    @classmethod
+    def from_device(cls, device):
+        unassigned_services = [
+            ServiceLess.from_service(each)
+            for each in device.unasigned_services
+        ]
+        apps = [AppLess.from_app(each) for each in device.apps]
+        return cls(unassigned_services, apps, device.characteristics,
+                   device.activity)
+
 
 class AppLess():
     """Used for JSON output"""
@@ -412,6 +684,11 @@ class AppLess():
         self.characteristics = characteristics
         self.services = services
 
+    @classmethod
+    def from_app(cls, app):
+        return cls(app.characteristics,
+                   [ServiceLess.from_service(each) for each in app.services])
+
 
 class ServiceLess():
     """Used for JSON output"""
@@ -422,3 +699,8 @@ class ServiceLess():
         self.type = type_param
         self.ips = list(ips)
         self.hosts = list(hosts)
+
+    @classmethod
+    def from_service(cls, service):
+        return cls(service.activity, service.name, service.type, service.ips,
+                   service.hosts)
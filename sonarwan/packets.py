@@ -0,0 +1,176 @@
+"""
+Compact packet records shared by every ingestion backend and the handlers.
+
+A record is extracted once per frame, so handlers read plain attributes
+instead of probing layers of the dissection.
+"""
+
+import socket
+
+from constants import Application
+
+DNS_TYPE_A = 1
+DNS_TYPE_CNAME = 5
+DNS_TYPE_AAAA = 28
+
+
+class PacketRecord(object):
+    """Fields of a frame consumed by the Environment and the handlers.
+
+    Addresses are integers, version tells whether they are IPv4 or IPv6.
+    Fields of protocols not present in the frame are None (False for flags).
+    """
+
+    __slots__ = ('timestamp', 'length', 'version', 'src', 'dst',
+                 'transport', 'stream', 'src_port', 'dst_port', 'tcp_flags',
+                 'application', 'dns_query', 'dns_answers', 'dns_ttl',
+                 'http_request', 'http_host', 'http_user_agent',
+                 'tls_client_hello', 'tls_cipher_suites', 'tls_server_name')
+
+    def __init__(self, timestamp, length):
+        self.timestamp = timestamp
+        self.length = length
+
+        self.version = None
+        self.src = None
+        self.dst = None
+
+        self.transport = None
+        # Identity of the stream, given by the Environment. See
+        # environment.get_flow_key
+        self.stream = None
+        self.src_port = None
+        self.dst_port = None
+        self.tcp_flags = 0
+
+        self.application = None
+
+        self.dns_query = None
+        # A and AAAA answers of dns_query, see set_dns_answers
+        self.dns_answers = None
+        # Lowest TTL of the answers, in seconds
+        self.dns_ttl = None
+
+        self.http_request = False
+        self.http_host = None
+        self.http_user_agent = None
+
+        self.tls_client_hello = False
+        self.tls_cipher_suites = None
+        self.tls_server_name = None
+
+    @property
+    def src_address(self):
+        return format_address(self.version, self.src)
+
+    @property
+    def dst_address(self):
+        return format_address(self.version, self.dst)
+
+
+def format_address(version, value):
+    if version == 4:
+        return socket.inet_ntoa(value.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+
+
+def parse_address(address):
+    """Returns (version, integer value) of an IP address string"""
+
+    if ':' in address:
+        return 6, int.from_bytes(
+            socket.inet_pton(socket.AF_INET6, address), 'big')
+    return 4, int.from_bytes(socket.inet_aton(address), 'big')
+
+
+def set_dns_answers(record, answers):
+    """Sets the addresses answered for the query of record and their lowest TTL.
+
+    answers are (name, type, value, ttl) of every resource record, value being
+    the address of A and AAAA records and the canonical name of CNAME records.
+    Addresses are kept if their name is the queried name or an alias of it,
+    following the CNAME chain, so all of them are answers for the query.
+    """
+
+    cnames = {}
+    for name, kind, value, ttl in answers:
+        if kind == DNS_TYPE_CNAME:
+            cnames[name.lower()] = (value.lower(), ttl)
+
+    lowest = None
+    names = None
+
+    if record.dns_query is not None:
+        name = record.dns_query.lower()
+        names = {name}
+        while name in cnames:
+            name, ttl = cnames[name]
+            if name in names:
+                # CNAME loop
+                break
+            names.add(name)
+            lowest = ttl if lowest is None else min(lowest, ttl)
+
+    addresses = []
+    for name, kind, value, ttl in answers:
+        if kind in (DNS_TYPE_A, DNS_TYPE_AAAA) and (names is None
+                                                   or name.lower() in names):
+            addresses.append(value)
+            lowest = ttl if lowest is None else min(lowest, ttl)
+
+    if addresses:
+        record.dns_answers = addresses
+        record.dns_ttl = lowest
+
+
+def zip_dns_answers(names, types, ttls, values):
+    """Answers of a DNS response dissected by tshark, as set_dns_answers
+    takes them.
+
+    names, types and ttls are given for every resource record, in order.
+    values maps A, AAAA and CNAME types to their values, in order.
+    """
+
+    remaining = {k: iter(v) for k, v in values.items()}
+    answers = []
+
+    for name, kind, ttl in zip(names, types, ttls):
+        kind = int(kind)
+        if kind in remaining:
+            value = next(remaining[kind], None)
+            if value is None:
+                break
+            answers.append((name, kind, value, int(ttl)))
+
+    return answers
+
+
+def get_shard(record, count):
+    """Shard of a record among count shards, by hash of its flow.
+
+    Both directions of a flow go to the same shard. Frames that are not
+    part of a TCP or UDP flow go to first shard.
+    """
+
+    if record.transport is None:
+        return 0
+
+    a = (record.src, record.src_port)
+    b = (record.dst, record.dst_port)
+
+    # Hash of integers is the same in every process
+    return hash((record.transport.value, min(a, b), max(a, b))) % count
+
+
+def get_application(layer_names):
+    """Application of a frame from its tshark layer names, from outermost to innermost"""
+
+    if 'http' in layer_names:
+        return Application.HTTP
+    if 'ssl' in layer_names or 'tls' in layer_names:
+        return Application.TLS
+    if layer_names[-1] == 'dns':
+        return Application.DNS
+    if layer_names[-1] in ('tcp', 'udp'):
+        return None
+    return Application.OTHER
@@ -0,0 +1,99 @@
+"""
+Parallel analysis of capture files.
+
+Every file is analyzed by a worker process with its own Environment. Partial
+results are merged in file order into the main Environment, so streams that
+continue in the next file are only attributed as a whole in sequential analysis.
+
+A file can also be split in shards by hash of the flow of each frame, so every
+TCP or UDP stream is analyzed by only one worker. DNS frames are analyzed by
+every shard, so all of them can find hosts of the addresses they see.
+"""
+
+import multiprocessing
+
+from environment import Environment
+from events import Reporter
+from packets import get_shard
+
+# Tools, backend and idle timeout of each worker process, set by init_worker
+worker_tools = None
+worker_backend = None
+worker_idle_timeout = None
+
+
+class PartialResult(object):
+    """Results of one capture file, sent back from worker to main process"""
+
+    def __init__(self, packets, environment):
+        self.packets = packets
+        self.start_time = environment.start_time
+        self.end_time = environment.end_time
+        self.devices = environment.devices
+        self.authorless_services = environment.authorless_services
+        self.host_cache = environment.host_cache
+
+        # Only counters of this file, see analyze_file
+        self.cache_stats = environment.service_analyzer.get_cache_stats()
+        self.cache_stats.update(environment.ua_analyzer.get_cache_stats())
+
+
+def init_worker(tools, backend, idle_timeout):
+    global worker_tools, worker_backend, worker_idle_timeout
+    worker_tools = tools
+    worker_backend = backend
+    worker_idle_timeout = idle_timeout
+
+    # Events are only reported by main process, when results are merged
+    Reporter().install()
+
+
+def analyze_file(task):
+    path, index, shards = task
+
+    environment = Environment(*worker_tools)
+    environment.idle_timeout = worker_idle_timeout
+
+    # Lookup caches are kept between files of the same worker
+    environment.service_analyzer.reset_cache_stats()
+    environment.ua_analyzer.reset_cache_stats()
+
+    packets = 0
+
+    if shards == 1:
+        for pkg in worker_backend.read(path):
+            packets += 1
+            environment.update(pkg)
+
+        return PartialResult(packets, environment)
+
+    for pkg in worker_backend.read(path, (index, shards)):
+        # DNS frames of other shards are analyzed but not counted
+        if get_shard(pkg, shards) == index:
+            packets += 1
+        environment.update(pkg)
+
+    partial = PartialResult(packets, environment)
+
+    # Every shard has the whole DNS cache of the file
+    if index != 0:
+        partial.host_cache.clear()
+
+    return partial
+
+
+def analyze_files(files, jobs, shards, tools, backend, idle_timeout=None):
+    """Yields a PartialResult for every shard of every file, in the same
+    order as files.
+
+    tools are (ua_analyzer, inference_engine, service_analyzer) as loaded
+    by main process.
+    """
+
+    tasks = [(each, index, shards) for each in files
+             for index in range(shards)]
+
+    with multiprocessing.Pool(jobs, init_worker,
+                              (tools, backend, idle_timeout)) as pool:
+        for each in pool.imap(analyze_file, tasks):
+            yield each
@@ -12,3 +12,5 @@ MOBILE_DETECTOR_PATH = os.path.join(BASE_DIR,
 SERVICES_DIRECTORY_PATH = os.path.join(BASE_DIR, './db/services/')
 
 LINUX_DISTRIBUTION_FILE = os.path.join(BASE_DIR, './db/linux.distributions')
+
+TOOLS_DATABASE_FILE = os.path.join(BASE_DIR, './db/tools.db')
@@ -0,0 +1,184 @@
+"""
+Minimal reader for libpcap and pcapng capture files.
+
+Only what is needed to walk the frames of a capture is decoded. Every frame
+is reported as a (timestamp, length, linktype, data) tuple, where timestamp is
+seconds since epoch as float, length is the original length of the frame on
+the wire and data are the captured bytes.
+
+Frames can be read from a file object or, through BufferReader, from a memory
+mapped file. In the latter case data is a memoryview of the mapping, so frames
+are not copied.
+"""
+
+import struct
+
+import errors
+
+PCAP_MAGIC_MICRO = 0xa1b2c3d4
+PCAP_MAGIC_NANO = 0xa1b23c4d
+
+PCAPNG_SECTION_HEADER = b'\x0a\x0d\x0d\x0a'
+PCAPNG_BYTE_ORDER_LITTLE = b'\x4d\x3c\x2b\x1a'
+PCAPNG_BYTE_ORDER_BIG = b'\x1a\x2b\x3c\x4d'
+
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_PACKET = 2
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+
+PCAPNG_OPTION_END = 0
+PCAPNG_OPTION_TSRESOL = 9
+PCAPNG_OPTION_TSOFFSET = 14
+
+
+class BufferReader(object):
+    """File like reader of a buffer. Read data are memoryview slices of it"""
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.position = 0
+
+    def read(self, size):
+        start = self.position
+        self.position += size
+        return self.view[start:self.position]
+
+    def release(self):
+        self.view.release()
+
+
+def read_frames(f):
+    """Yields every frame of a pcap or pcapng file object opened in binary mode
+    or of a BufferReader
+    """
+
+    head = f.read(4)
+    if len(head) < 4:
+        raise errors.InvalidCaptureFileError()
+
+    if head == PCAPNG_SECTION_HEADER:
+        return _read_pcapng(f, head)
+    return _read_pcap(f, head)
+
+
+def _read_pcap(f, magic):
+    for endian in '<>':
+        number = struct.unpack(endian + 'I', magic)[0]
+        if number in (PCAP_MAGIC_MICRO, PCAP_MAGIC_NANO):
+            break
+    else:
+        raise errors.InvalidCaptureFileError()
+
+    resolution = 1e-6 if number == PCAP_MAGIC_MICRO else 1e-9
+
+    header = f.read(20)
+    if len(header) < 20:
+        raise errors.InvalidCaptureFileError()
+
+    # Upper bits of the link type field carry FCS information
+    linktype = struct.unpack(endian + 'HHiIII', header)[5] & 0xffff
+
+    return _pcap_frames(f, struct.Struct(endian + 'IIII'), resolution,
+                        linktype)
+
+
+def _pcap_frames(f, record, resolution, linktype):
+    while True:
+        raw = f.read(16)
+        if len(raw) < 16:
+            return
+
+        seconds, fraction, captured, length = record.unpack(raw)
+
+        data = f.read(captured)
+        if len(data) < captured:
+            # Truncated capture, last frame is incomplete
+            return
+
+        yield seconds + fraction * resolution, length, linktype, data
+
+
+def _read_pcapng(f, head):
+    endian = '<'
+    interfaces = []
+    last_timestamp = 0.0
+
+    header = bytes(head) + bytes(f.read(4))
+    while len(header) == 8:
+
+        if header[:4] == PCAPNG_SECTION_HEADER:
+            # Byte order can change from one section to another
+            byte_order = f.read(4)
+            if byte_order == PCAPNG_BYTE_ORDER_LITTLE:
+                endian = '<'
+            elif byte_order == PCAPNG_BYTE_ORDER_BIG:
+                endian = '>'
+            else:
+                raise errors.InvalidCaptureFileError()
+
+            total = struct.unpack(endian + 'I', header[4:])[0]
+            f.read(total - 12)
+
+            # Interface ids are local to each section
+            interfaces = []
+
+        else:
+            block_type, total = struct.unpack(endian + 'II', header)
+            body = f.read(total - 8)
+            if len(body) < total - 8:
+                return
+
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                interfaces.append(_parse_interface(body, endian))
+
+            elif block_type == PCAPNG_ENHANCED_PACKET:
+                interface, high, low, captured, length = struct.unpack_from(
+                    endian + 'IIIII', body)
+                linktype, resolution, offset = interfaces[interface]
+                last_timestamp = ((high << 32) | low) * resolution + offset
+                yield last_timestamp, length, linktype, body[20:20 + captured]
+
+            elif block_type == PCAPNG_PACKET:
+                interface, _, high, low, captured, length = struct.unpack_from(
+                    endian + 'HHIIII', body)
+                linktype, resolution, offset = interfaces[interface]
+                last_timestamp = ((high << 32) | low) * resolution + offset
+                yield last_timestamp, length, linktype, body[20:20 + captured]
+
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                # Simple packets carry no timestamp, so the last one seen is used
+                length = struct.unpack_from(endian + 'I', body)[0]
+                captured = min(length, len(body) - 8)
+                yield last_timestamp, length, interfaces[0][0], body[
+                    4:4 + captured]
+
+        header = f.read(8)
+
+
+def _parse_interface(body, endian):
+    """Returns (linktype, timestamp resolution, timestamp offset) of an interface"""
+
+    linktype = struct.unpack_from(endian + 'H', body)[0]
+    resolution = 1e-6
+    offset = 0
+
+    position = 8
+    while position + 4 <= len(body) - 4:
+        code, size = struct.unpack_from(endian + 'HH', body, position)
+        value = body[position + 4:position + 4 + size]
+
+        if code == PCAPNG_OPTION_END:
+            break
+        elif code == PCAPNG_OPTION_TSRESOL:
+            if value[0] & 0x80:
+                resolution = 2**-(value[0] & 0x7f)
+            else:
+                resolution = 10**-value[0]
+        elif code == PCAPNG_OPTION_TSOFFSET:
+            offset = struct.unpack(endian + 'q', value)[0]
+
+        # Option values are padded to 32 bits
+        position += 4 + ((size + 3) & ~3)
+
+    return linktype, resolution, offset
@@ -1,16 +1,25 @@
-import pyshark
 import time
 import json
 import sys
 from logger import logger
 
 from environment import Environment
-from models import AppLess, DeviceLess, ServiceLess
+from models import DeviceLess, ServiceLess
 
 import utils
 import errors
+import events
+import backends
+import parallel
+import checkpoint
+import compressed
 
-from tools import main_tools
+from tools import database
+
+# Seconds without packets after which a stream is forgotten, unless
+# --idle-timeout is given. Flows are kept between capture files, so streams
+# that are never closed must be forgotten too
+IDLE_TIMEOUT = 300
 
 
 class SonarWan(object):
@@ -19,14 +28,11 @@ class SonarWan(object):
         self.arguments = arguments
 
         try:
-            ua_analyzer = main_tools.UserAgentAnalyzer(
-                self.arguments.user_patterns_file)
-
-            inference_engine = main_tools.InferenceEngine(
-                self.arguments.user_inference_directory)
-
-            service_analyzer = main_tools.ServiceAnalyzer(
-                self.arguments.user_services_directory)
+            ua_analyzer, inference_engine, service_analyzer = database.load_tools(
+                self.arguments.user_patterns_file,
+                self.arguments.user_inference_directory,
+                self.arguments.user_services_directory,
+                self.arguments.tools_database)
 
         except errors.ServiceDirectoryNotFoundError:
             utils.report_error(
@@ -63,10 +69,52 @@ class SonarWan(object):
             logger.error(e)
             sys.exit(1)
 
+        ua_analyzer.set_cache_size(self.arguments.lookup_cache_size)
+        service_analyzer.set_cache_size(self.arguments.lookup_cache_size)
+
         logger.info('Finish loading tools')
+
+        try:
+            self.backend = backends.create_backend(
+                self.arguments.backend, self.arguments.display_filter)
+
+        except errors.BackendNotAvailableError as e:
+            utils.report_error("{} backend is not available".format(e.name),
+                               self.arguments.json_output)
+            logger.error(e)
+            sys.exit(1)
+        except errors.UnsupportedDisplayFilterError as e:
+            utils.report_error(
+                "{} backend does not support display filters".format(e.name),
+                self.arguments.json_output)
+            logger.error(e)
+            sys.exit(1)
+
+        if self.arguments.shards > 1 and not self.backend.supports_sharding:
+            utils.report_error(
+                "{} backend does not support --shards".format(
+                    self.arguments.backend), self.arguments.json_output)
+            sys.exit(1)
+
         self.environment = Environment(ua_analyzer, inference_engine,
                                        service_analyzer)
 
+        if self.arguments.ndjson_output:
+            self.environment.set_reporter(self.create_reporter())
+
+        self.checkpointer = None
+        if self.arguments.checkpoint_file:
+            self.checkpointer = checkpoint.Checkpointer(
+                self.arguments.checkpoint_file,
+                self.arguments.checkpoint_interval)
+
+    def create_reporter(self):
+        if self.arguments.file_output:
+            fd = open(self.arguments.file_output, 'w')
+        else:
+            fd = sys.stdout
+        return events.NDJSONReporter(fd, self.arguments.events_interval)
+
     def show_progress(self, path):
         if not self.arguments.json_output:
             utils.show_progress(self.i)
@@ -81,16 +129,53 @@ class SonarWan(object):
                 self.arguments.json_output)
             sys.exit(1)
 
+        for each in files:
+            name = compressed.get_compression(each)
+            if name and name not in self.backend.compressions:
+                utils.report_error(
+                    "{} backend can not read {} compressed files".format(
+                        self.arguments.backend, name),
+                    self.arguments.json_output)
+                sys.exit(1)
+            if name and not compressed.is_available(name):
+                utils.report_error(
+                    "{} compressed files require zstandard package".format(
+                        name), self.arguments.json_output)
+                sys.exit(1)
+
         self.start_time = time.time()
         self.i = 0
         self.file_count = 0
 
+        self.files = files
+        self.file_index = 0
+        skip = 0
+
+        self.environment.idle_timeout = self.get_idle_timeout()
+
+        if self.arguments.resume:
+            skip = self.restore_checkpoint()
+
+        first = self.file_index
+        each = files[first] if first < len(files) else ''
+
         try:
-            for each in files:
-                logger.info('Processing {}'.format(each[each.rindex('/') +
-                                                        1:]))
-                self.file_count += 1
-                self.analyze(each)
+            if self.arguments.jobs > 1 or self.arguments.shards > 1:
+                if skip:
+                    # Checkpoint was taken in the middle of a file
+                    self.file_count += 1
+                    self.analyze(each, skip)
+                    first += 1
+                self.analyze_parallel(files, first)
+            else:
+                for index in range(first, len(files)):
+                    self.file_index = index
+                    each = files[index]
+                    logger.info('Processing {}'.format(each[each.rindex(
+                        '/') + 1:]))
+                    self.file_count += 1
+                    self.analyze(each, skip)
+                    skip = 0
 
         except Exception as e:
             utils.report_error(
@@ -99,28 +184,207 @@ class SonarWan(object):
             logger.error(str(e))
             sys.exit(1)
 
+        if self.checkpointer:
+            self.checkpointer.remove()
+
         logger.info('Succesfully analyzed all files')
+        self.log_cache_stats()
         self.total_time = time.time() - self.start_time
         self.environment.sort_results()
 
+    def run_live(self, interface):
+        """Analyzes traffic of interface until interrupted.
+
+        Every report_interval seconds a report is printed and state that is
+        no longer needed is evicted, so memory does not grow with uptime.
+        Reports are emitted with the first packet after each interval.
+        """
+
+        self.start_time = time.time()
+        self.i = 0
+        self.file_count = 0
+
+        idle_timeout = self.get_idle_timeout()
+        self.environment.idle_timeout = idle_timeout
+
+        next_report = None
+
+        try:
+            logger.info('Capturing from {}'.format(interface))
+            for pkg in self.backend.live(interface, idle_timeout):
+                self.i += 1
+
+                self.show_progress(interface)
+                self.environment.update(pkg)
+                self.environment.reporter.tick(pkg.timestamp)
+
+                if next_report is None:
+                    next_report = pkg.timestamp + self.arguments.report_interval
+
+                elif pkg.timestamp >= next_report:
+                    self.report_live(pkg.timestamp)
+                    next_report = pkg.timestamp + self.arguments.report_interval
+
+        except KeyboardInterrupt:
+            logger.info('Capture from {} interrupted'.format(interface))
+
+        except Exception as e:
+            utils.report_error(
+                "Unexpected error occured while capturing from {}".format(
+                    interface), self.arguments.json_output)
+            logger.error(str(e))
+            sys.exit(1)
+
+        self.log_cache_stats()
+        self.total_time = time.time() - self.start_time
+        self.environment.sort_results()
+
+    def get_idle_timeout(self):
+        """--idle-timeout 0 keeps streams until they are closed"""
+
+        if self.arguments.idle_timeout is None:
+            return IDLE_TIMEOUT
+        return self.arguments.idle_timeout
+
+    def get_cache_stats(self):
+        stats = self.environment.service_analyzer.get_cache_stats()
+        stats.update(self.environment.ua_analyzer.get_cache_stats())
+        stats['dns'] = self.environment.host_cache.get_stats()
+        return stats
+
+    def log_cache_stats(self):
+        for name, stats in sorted(self.get_cache_stats().items()):
+            logger.info(
+                '{} cache: {} entries, {} hits, {} misses, {} evictions'.format(
+                    name.upper(), stats['size'], stats['hits'],
+                    stats['misses'], stats['evictions']))
+
+    def report_live(self, now):
+        self.total_time = time.time() - self.start_time
+        self.environment.sort_results()
+
+        # Incremental output already reports everything as it happens
+        if not self.arguments.ndjson_output:
+            self.print_info()
+
+        self.environment.evict_activity_before(
+            now - self.arguments.activity_retention)
+
     def is_valid_file(self, path):
+        path = compressed.strip_extension(path)
         return path.endswith('.pcap') or path.endswith('.pcapng')
 
-    def analyze(self, path):
-        cap = pyshark.FileCapture(path)
+    def analyze(self, path, skip=0):
+        """skip is the amount of frames of the file already analyzed
+        before a checkpoint was taken
+        """
+
+        cap = self.backend.read(path)
 
-        # Should prepare environment first to remove all maps, 
-        # as the stream numbers will be repeated between files
-        self.environment.prepare()
+        frames = 0
 
         for pkg in cap:
+            frames += 1
+            if frames <= skip:
+                continue
+
             self.i += 1
 
             self.show_progress(path)
             self.environment.update(pkg)
+            self.environment.reporter.tick(pkg.timestamp)
+
+            if self.checkpointer and self.checkpointer.due():
+                self.save_checkpoint(self.file_index, frames)
+
+    def save_checkpoint(self, file_index, frames):
+        """frames is the amount of frames analyzed of file at file_index"""
+
+        logger.info('Saving checkpoint at frame {} of file {}'.format(
+            frames, file_index))
+        self.checkpointer.save(
+            checkpoint.Checkpoint(self.files, file_index, frames, self.i,
+                                  self.environment.get_state(),
+                                  self.environment.reporter.get_state()))
+
+    def restore_checkpoint(self):
+        """Restores state from last checkpoint, if any.
+        Returns the amount of frames to skip of current file.
+        """
+
+        try:
+            last = self.checkpointer.load()
+        except errors.InvalidCheckpointError as e:
+            utils.report_error("{} is not a valid checkpoint".format(e.path),
+                               self.arguments.json_output)
+            sys.exit(1)
+
+        if last is None:
+            logger.info('No checkpoint found, starting from the beginning')
+            return 0
+
+        if last.files != self.files:
+            utils.report_error(
+                "checkpoint was taken while analyzing other capture files",
+                self.arguments.json_output)
+            sys.exit(1)
+
+        self.environment.set_state(last.state)
+        self.environment.reporter.set_state(last.reporter_state)
+        self.i = last.packets
+        self.file_index = last.file_index
+        self.file_count = last.file_index
+
+        logger.info('Resuming from frame {} of file {}'.format(
+            last.frames, last.file_index))
+        return last.frames
+
+    def analyze_parallel(self, files, first=0):
+        """Each file, or each shard of each file, is analyzed in a worker
+        process. Results are merged in files order.
+
+        Files before first were already analyzed.
+        """
+
+        tools = (self.environment.ua_analyzer,
+                 self.environment.inference_engine,
+                 self.environment.service_analyzer)
+
+        shards = self.arguments.shards
+
+        # Unless told otherwise, one process per shard
+        jobs = self.arguments.jobs if self.arguments.jobs > 1 else shards
+
+        results = parallel.analyze_files(files[first:], jobs, shards, tools,
+                                         self.backend,
+                                         self.get_idle_timeout())
+
+        for position in range(first, len(files)):
+            each = files[position]
+            for index in range(shards):
+                partial = next(results)
+                self.i += partial.packets
+                self.environment.merge(partial)
+                self.environment.service_analyzer.add_cache_stats(
+                    partial.cache_stats)
+                self.environment.ua_analyzer.add_cache_stats(
+                    partial.cache_stats)
+                if partial.end_time is not None:
+                    self.environment.reporter.tick(partial.end_time)
+
+            logger.info('Merged {}'.format(each[each.rindex('/') + 1:]))
+            self.file_count += 1
+
+            self.show_progress(each)
+
+            # Checkpoints are only taken between files
+            if self.checkpointer and self.checkpointer.due():
+                self.save_checkpoint(position + 1, 0)
 
     def print_info(self):
-        if self.arguments.json_output:
+        if self.arguments.ndjson_output:
+            self.environment.reporter.finish(self.environment, Summary(self))
+        elif self.arguments.json_output:
             sonarwan_full = SonarwanRep(self)
             print(sonarwan_full.toJSON())
         else:
@@ -135,8 +399,11 @@ class Summary(object):
         self.packets = sonarwan.i
         self.execution_time = int(sonarwan.total_time * 100) / 100
         self.files = sonarwan.file_count
-        self.start_time = sonarwan.environment.start_time.isoformat()
-        self.end_time = sonarwan.environment.end_time.isoformat()
+        self.start_time = utils.format_time(sonarwan.environment.start_time)
+        self.end_time = utils.format_time(sonarwan.environment.end_time)
+
+        # Hits, misses and evictions of DNS, url, ip and user agent caches
+        self.caches = sonarwan.get_cache_stats()
 
 
 class SonarwanRep(object):
@@ -149,36 +416,14 @@ class SonarwanRep(object):
     def init_devices(self, devices):
         """Generates device list with only neccessary info for JSON output"""
 
-        self.devices = []
-        for each in devices:
-            apps = []
-            unassigned_services = []
-            for each_service in each.unasigned_services:
-                unassigned_services.append(
-                    ServiceLess(each_service.activity, each_service.name,
-                                each_service.type, each_service.ips,
-                                each_service.hosts))
-            for each_app in each.apps:
-                services = []
-                for each_service in each_app.services:
-                    services.append(
-                        ServiceLess(each_service.activity, each_service.name,
-                                    each_service.type, each_service.ips,
-                                    each_service.hosts))
-                apps.append(AppLess(each_app.characteristics, services))
-
-            self.devices.append(
-                DeviceLess(unassigned_services, apps, each.characteristics,
-                           each.activity))
+        self.devices = [DeviceLess.from_device(each) for each in devices]
 
     def init_services(self, services):
         """Generates authorless service list with only neccessary info for JSON output"""
 
-        self.authorless_services = []
-        for each in services:
-            self.authorless_services.append(
-                ServiceLess(each.activity, each.name, each.type, each.ips,
-                            each.hosts))
+        self.authorless_services = [
+            ServiceLess.from_service(each) for each in services
+        ]
 
     def toJSON(self):
         """
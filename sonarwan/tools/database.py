@@ -0,0 +1,130 @@
+"""
+Precompiled database of the analysis tools.
+
+Loading the tools parses every pattern, inference, service and Mobile Detect
+file and builds lookup structures from them. Loaded tools are saved to a
+single file, keyed by size and modification time of every source file and of
+the modules of the tools, so following runs load them at once. The file is
+rebuilt when any source changes.
+"""
+
+import os
+import pickle
+
+import paths
+import models
+
+from logger import logger
+from tools import cache, main_tools, mobile_detector
+
+# Incremented when the saved format changes
+DATABASE_VERSION = 1
+
+SOURCE_MODULES = (main_tools, mobile_detector, cache, models)
+
+
+class Database(object):
+    def __init__(self, key, tools):
+        self.version = DATABASE_VERSION
+        self.key = key
+        self.tools = tools
+
+
+def load_tools(user_patterns_file, user_inference_directory,
+               user_services_directory, path):
+    """Returns (ua_analyzer, inference_engine, service_analyzer), from the
+    database at path if it is up to date. Otherwise tools are loaded from
+    their sources and the database is rebuilt.
+    """
+
+    key = get_key(user_patterns_file, user_inference_directory,
+                  user_services_directory)
+
+    if key is not None and path:
+        database = read(path)
+        if database and database.version == DATABASE_VERSION and (
+                database.key == key):
+            logger.info('Tools loaded from {}'.format(path))
+            return database.tools
+
+    tools = (main_tools.UserAgentAnalyzer(user_patterns_file),
+             main_tools.InferenceEngine(user_inference_directory),
+             main_tools.ServiceAnalyzer(user_services_directory))
+
+    if key is not None and path:
+        write(path, Database(key, tools))
+
+    return tools
+
+
+def get_key(user_patterns_file, user_inference_directory,
+            user_services_directory):
+    """Path, size and modification time of every source. None if some source
+    can not be found, so tools report it when loaded.
+    """
+
+    files = [
+        paths.USER_AGENT_PATTERNS_FILE, paths.LINUX_DISTRIBUTION_FILE,
+        paths.MOBILE_DETECTOR_PATH
+    ]
+    files.extend(each.__file__ for each in SOURCE_MODULES)
+
+    directories = [(paths.INFERENCE_DIR, '.csv'),
+                   (paths.SERVICES_DIRECTORY_PATH, '.yaml')]
+
+    if user_patterns_file:
+        files.append(user_patterns_file)
+    if user_inference_directory:
+        directories.append((user_inference_directory, '.csv'))
+    if user_services_directory:
+        directories.append((user_services_directory, '.yaml'))
+
+    try:
+        for directory, extension in directories:
+            files.extend(
+                directory + each for each in sorted(os.listdir(directory))
+                if each.endswith(extension))
+
+        key = []
+        for each in files:
+            stat = os.stat(each)
+            key.append((os.path.abspath(each), stat.st_size,
+                        stat.st_mtime_ns))
+        return tuple(key)
+
+    except OSError:
+        return None
+
+
+def read(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    except FileNotFoundError:
+        return None
+
+    except Exception as e:
+        logger.warning('Ignoring tools database {}: {}'.format(path, e))
+        return None
+
+
+def write(path, database):
+    """Written to a temporary file first, so a database is never left half
+    written
+    """
+
+    # Unique per process, as many runs can rebuild it at the same time
+    temporal = '{}.{}.tmp'.format(path, os.getpid())
+
+    try:
+        with open(temporal, 'wb') as f:
+            pickle.dump(database, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal, path)
+        logger.info('Tools database saved to {}'.format(path))
+
+    except OSError as e:
+        logger.warning('Could not save tools database {}: {}'.format(
+            path, e))
+        if os.path.exists(temporal):
+            os.remove(temporal)
@@ -10,9 +10,60 @@ from os.path import isfile, join
 
 from ua_parser import user_agent_parser
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 from tools.mobile_detector import MobileDetector
+from tools.cache import LRUCache
+
+from models import ServiceDescriptor
+from packets import parse_address
+
+# Hosts and addresses whose services are remembered by URLAnalyzer and
+# IPAnalyzer, and user agents remembered by UserAgentAnalyzer, unless told
+# otherwise
+LOOKUP_CACHE_SIZE = 65536
+
+# Returned by LRUCache.get when a result is not cached, as None is cached too
+NOT_CACHED = object()
+
+# Shorter literals of user agent patterns are not worth looking for
+MIN_LITERAL_LENGTH = 3
+
+
+def get_required_literals(pattern):
+    """Literal strings that every match of pattern contains. Only text out of
+    alternatives, repetitions and classes is taken, so none can be missed.
+    """
+
+    parsed = sre_parse.parse(pattern)
+    if parsed.state.flags & re.IGNORECASE:
+        return ()
+
+    literals = []
+    current = []
+
+    def flush():
+        if len(current) >= MIN_LITERAL_LENGTH:
+            literals.append(''.join(current))
+        del current[:]
 
-from models import Service
+    def walk(items):
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                current.append(chr(av))
+            elif op is sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+                # Content of a group is matched once, between its neighbours
+                walk(av[-1])
+            else:
+                flush()
+
+    walk(parsed)
+    flush()
+
+    return tuple(sorted(literals, key=len, reverse=True))
 
 
 class InferenceEngine(object):
@@ -187,6 +238,23 @@ class UserAgentAnalyzer(object):
         self.load_linux_distributions_file()
         self.complement = ComplementaryUAAnalyzers()
 
+        # User agent to its (device_args, app_args)
+        self.cache = LRUCache(LOOKUP_CACHE_SIZE)
+
+    def set_cache_size(self, size):
+        """Empties the user agent cache, that will keep up to size results"""
+        self.cache = LRUCache(size)
+
+    def get_cache_stats(self):
+        return {'ua': self.cache.get_stats()}
+
+    def add_cache_stats(self, stats):
+        """Adds counters of get_cache_stats of another UserAgentAnalyzer"""
+        self.cache.add_stats(stats['ua'])
+
+    def reset_cache_stats(self):
+        self.cache.reset_stats()
+
     def load_linux_distributions_file(self):
         self.linux_distributions = []
         try:
@@ -205,6 +273,8 @@ class UserAgentAnalyzer(object):
         if user_patterns_file:
             self.load_file(user_patterns_file)
 
+        self.compile_patterns()
+
     def load_file(self, path):
         try:
             with open(path) as f:
@@ -215,16 +285,42 @@ class UserAgentAnalyzer(object):
         except:
             raise errors.PatternFileNotFileError()
 
+    def compile_patterns(self):
+        """Patterns are kept as (compiled, required literals), sorted by
+        amount of named groups (file order if equal). So the first pattern
+        that matches is the one with most named groups.
+        """
+
+        try:
+            compiled = [(re.compile(each), get_required_literals(each))
+                        for each in self.user_agents]
+        except re.error:
+            raise errors.PatternFileNotFileError()
+
+        self.patterns = sorted(
+            compiled, key=lambda each: len(each[0].groupindex), reverse=True)
+
     def get_best_match(self, user_agent):
-        max_size = -1
+        """Returns {'device_args': ..., 'app_args': ...} of user_agent.
+        Results are cached, so copies are returned for callers to keep.
+        """
+
+        ret = self.cache.get(user_agent)
+        if ret is None:
+            ret = self.analyze(user_agent)
+            self.cache.put(user_agent, ret)
+
+        device_args, app_args = ret
+        return {'device_args': dict(device_args), 'app_args': dict(app_args)}
+
+    def analyze(self, user_agent):
         best_match = None
-        for pattern in self.user_agents:
-            match = re.match(pattern, user_agent)
-            if match:
-                groups = match.groupdict()
-                if (len(groups) > max_size):
-                    max_size = len(groups)
-                    best_match = groups
+        for pattern, literals in self.patterns:
+            if all(each in user_agent for each in literals):
+                match = pattern.match(user_agent)
+                if match:
+                    best_match = match.groupdict()
+                    break
 
         device_args, app_args = {}, {}
         if best_match:
@@ -257,7 +353,7 @@ class UserAgentAnalyzer(object):
             app_args[k] = "".join([ c if c.isalnum() else other for c in v ])
 
 
-        return {'device_args': device_args, 'app_args': app_args}
+        return device_args, app_args
 
 
 class ServiceAnalyzer(object):
@@ -265,6 +361,9 @@ class ServiceAnalyzer(object):
 
         self.service_info_map = {}
 
+        # Name to ServiceDescriptor, shared by every lookup
+        self.descriptors = {}
+
         self.url_analyzer = URLAnalyzer()
         self.ip_analyzer = IPAnalyzer()
 
@@ -273,6 +372,31 @@ class ServiceAnalyzer(object):
         if user_services_directory:
             self.load_files(user_services_directory)
 
+        self.url_analyzer.build()
+        self.ip_analyzer.build()
+
+    def set_cache_size(self, size):
+        """Empties lookup caches, that will keep up to size results each"""
+
+        self.url_analyzer.cache = LRUCache(size)
+        self.ip_analyzer.cache = LRUCache(size)
+
+    def get_cache_stats(self):
+        return {
+            'url': self.url_analyzer.cache.get_stats(),
+            'ip': self.ip_analyzer.cache.get_stats()
+        }
+
+    def add_cache_stats(self, stats):
+        """Adds counters of get_cache_stats of another ServiceAnalyzer"""
+
+        self.url_analyzer.cache.add_stats(stats['url'])
+        self.ip_analyzer.cache.add_stats(stats['ip'])
+
+    def reset_cache_stats(self):
+        self.url_analyzer.cache.reset_stats()
+        self.ip_analyzer.cache.reset_stats()
+
     def load_service(self, content, full_path):
         try:
             name = content['name']
@@ -282,6 +406,8 @@ class ServiceAnalyzer(object):
                 for k, v in content.items()
                 if k not in ['urls', 'ips', 'absolute-urls']
             }
+            self.descriptors[name] = ServiceDescriptor.from_characteristics(
+                self.service_info_map[name])
 
             if content.get('absolute-urls'):
                 self.url_analyzer.absolute_service_map[name] = set(content[
@@ -335,69 +461,153 @@ class ServiceAnalyzer(object):
     def _generic_find(self, parameter, function):
         name = function(parameter)
         if name:
-            return Service.from_characteristics(self.service_info_map[name])
+            return self.descriptors[name]
         return None
 
 
+class DomainNode(object):
+    """Node of the domain trie of URLAnalyzer. Children are keyed by label,
+    so the path from the root spells a domain from right to left.
+    """
+
+    __slots__ = ('children', 'absolute', 'suffix')
+
+    def __init__(self):
+        self.children = {}
+
+        # Service of the domain of this node only
+        self.absolute = None
+
+        # Service of the domain of this node and all its subdomains
+        self.suffix = None
+
+
 class URLAnalyzer(object):
+    """Finds service of a host among the urls (the domain and its subdomains)
+    and absolute urls (the domain only) of every service. build must be
+    called once all services are loaded.
+    """
+
     def __init__(self):
         self.service_map = {}
         self.absolute_service_map = {}
 
-        self.not_found_cache = set()
-        self.found_cache = {}
+        self.root = DomainNode()
 
-    def absolute_find_service(self, url):
-        if url in self.not_found_cache:
-            return None
+        # Host to (absolute, suffix) services
+        self.cache = LRUCache(LOOKUP_CACHE_SIZE)
 
-        name = self.found_cache.get(url)
-        if name:
-            return name
-        else:
-            for k, v in self.absolute_service_map.items():
-                if url in v:
-                    self.found_cache[url] = k
-                    return k
+    def build(self):
+        """Indexes domains of service_map and absolute_service_map. When the
+        same domain belongs to many services, first one is kept.
+        """
 
-            self.not_found_cache.add(url)
-            return None
+        self.root = DomainNode()
+        self.cache = LRUCache(LOOKUP_CACHE_SIZE)
+
+        for k, v in self.absolute_service_map.items():
+            for each in v:
+                node = self.get_node(each)
+                node.absolute = node.absolute or k
 
-    def intensive_find_service(self, url):
         for k, v in self.service_map.items():
             for each in v:
-                dif = len(url) - len(each)
-                if dif < 0:
-                    continue
-                match = True
-                for i in range(len(each) - 1, -1, -1):
-                    if each[i] != url[i + dif]:
-                        match = False
-                if match:
-                    return k
-        return None
+                node = self.get_node(each)
+                node.suffix = node.suffix or k
+
+    def get_node(self, domain):
+        node = self.root
+        for label in reversed(domain.lower().split('.')):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = DomainNode()
+            node = child
+        return node
+
+    def find(self, url):
+        """Returns service of url as absolute url and service of the longest
+        url that url is subdomain of (or equal to)
+        """
+
+        ret = self.cache.get(url)
+        if ret is not None:
+            return ret
+
+        node = self.root
+        absolute, suffix = None, None
+
+        for label in reversed(url.lower().split('.')):
+            node = node.children.get(label)
+            if node is None:
+                break
+            suffix = node.suffix or suffix
+        else:
+            absolute = node.absolute
+
+        ret = (absolute, suffix)
+        self.cache.put(url, ret)
+        return ret
+
+    def absolute_find_service(self, url):
+        return self.find(url)[0]
+
+    def intensive_find_service(self, url):
+        return self.find(url)[1]
 
 
 class IPAnalyzer(object):
+    """Finds service of an address by longest prefix match among the
+    networks of every service. build must be called once all services
+    are loaded.
+    """
+
     def __init__(self):
         self.service_map = {}
 
-        self.not_found_cache = set()
-        self.found_cache = {}
+        # IP version to {prefix length: {network prefix: service name}}
+        self.prefixes = {4: {}, 6: {}}
 
-    def find_service(self, ipaddr):
-        if ipaddr in self.not_found_cache:
-            return None
+        # IP version to prefix lengths in prefixes, longest first
+        self.lengths = {4: [], 6: []}
 
-        name = self.found_cache.get(ipaddr)
-        if name:
+        # Address to service name, None if it has no service
+        self.cache = LRUCache(LOOKUP_CACHE_SIZE)
+
+    def build(self):
+        """Indexes networks of service_map. When the same network belongs to
+        many services, first one in service_map is kept.
+        """
+
+        self.prefixes = {4: {}, 6: {}}
+        self.cache = LRUCache(LOOKUP_CACHE_SIZE)
+
+        for k, v in self.service_map.items():
+            for each in v:
+                table = self.prefixes[each.version].setdefault(
+                    each.prefixlen, {})
+                prefix = int(each.network_address) >> (
+                    each.max_prefixlen - each.prefixlen)
+                table.setdefault(prefix, k)
+
+        self.lengths = {
+            version: sorted(tables, reverse=True)
+            for version, tables in self.prefixes.items()
+        }
+
+    def find_service(self, ipaddr):
+        name = self.cache.get(ipaddr, NOT_CACHED)
+        if name is not NOT_CACHED:
             return name
-        else:
-            for k, v in self.service_map.items():
-                for each in v:
-                    if ipaddress.ip_address(ipaddr) in each:
-                        self.found_cache[ipaddr] = k
-                        return k
-
-            self.not_found_cache.add(ipaddr)
-            return None
+
+        version, value = parse_address(ipaddr)
+        bits = 32 if version == 4 else 128
+        tables = self.prefixes[version]
+
+        name = None
+        for length in self.lengths[version]:
+            name = tables[length].get(value >> (bits - length))
+            if name:
+                break
+
+        self.cache.put(ipaddr, name)
+        return name
@@ -4,9 +4,20 @@ from tabulate import tabulate
 import json
 import sys
 
+from datetime import datetime
+
 FRAMES_TO_INFORM = 10
 
 
+def get_time_bucket(timestamp):
+    """Activity is grouped by second. Returns the second as ISO string"""
+    return datetime.fromtimestamp(int(timestamp)).isoformat()
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+
 def sort_by_value(l, value_map, ascending=True):
     asc = 1 if ascending else -1
     for i in range(len(l) - 1):
@@ -55,6 +66,9 @@ def pretty_print(sonarwan, file_output=None):
     fd.write("{} packets were analyzed.\n".format(sonarwan.i))
     fd.write("Execution time: {}\n".format((time.time() - sonarwan.start_time
                                             )))
+    for name, stats in sorted(sonarwan.get_cache_stats().items()):
+        fd.write("{} cache: {} hits, {} misses, {} evictions.\n".format(
+            name.upper(), stats['hits'], stats['misses'], stats['evictions']))
     print_title("DETAILS", fd)
     print_title("Devices", fd)
     for i, d in enumerate(sonarwan.environment.devices):
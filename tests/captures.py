@@ -0,0 +1,131 @@
+"""
+Builders of small synthetic captures for tests.
+"""
+
+import socket
+import struct
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+
+TCP_SYN = 0x02
+TCP_FIN = 0x01
+TCP_PSH_ACK = 0x18
+
+
+def ethernet(payload, ethertype=ETHERTYPE_IPV4):
+    return (b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb' +
+            struct.pack('>H', ethertype) + payload)
+
+
+def ipv4(src, dst, protocol, payload):
+    return struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 1, 0, 64,
+                       protocol, 0, socket.inet_aton(src),
+                       socket.inet_aton(dst)) + payload
+
+
+def ipv6(src, dst, protocol, payload):
+    return struct.pack('>IHBB16s16s', 0x60000000, len(payload), protocol, 64,
+                       socket.inet_pton(socket.AF_INET6, src),
+                       socket.inet_pton(socket.AF_INET6, dst)) + payload
+
+
+def tcp(src_port, dst_port, payload=b'', flags=TCP_PSH_ACK):
+    return struct.pack('>HHIIHHHH', src_port, dst_port, 1, 1,
+                       (5 << 12) | flags, 65535, 0, 0) + payload
+
+
+def udp(src_port, dst_port, payload):
+    return struct.pack('>HHHH', src_port, dst_port, 8 + len(payload),
+                       0) + payload
+
+
+def dns_name(name):
+    return b''.join(
+        bytes([len(each)]) + each.encode() for each in name.split('.')) + b'\x00'
+
+
+def dns_response(query, answers):
+    """answers are (name, type, ttl, value), value being an address for A and
+    AAAA records and a name for CNAME records
+    """
+
+    question = dns_name(query) + struct.pack('>HH', 1, 1)
+
+    records = b''
+    for name, kind, ttl, value in answers:
+        if kind == 5:
+            data = dns_name(value)
+        elif kind == 28:
+            data = socket.inet_pton(socket.AF_INET6, value)
+        else:
+            data = socket.inet_aton(value)
+        records += dns_name(name) + struct.pack('>HHIH', kind, 1, ttl,
+                                                len(data)) + data
+
+    return struct.pack('>HHHHHH', 1, 0x8180, 1, len(answers), 0,
+                       0) + question + records
+
+
+def http_request(host, user_agent):
+    return ('GET / HTTP/1.1\r\nHost: {}\r\nUser-Agent: {}\r\n\r\n'.format(
+        host, user_agent)).encode()
+
+
+def client_hello(server_name):
+    name = server_name.encode()
+    extension = struct.pack('>HBH', len(name) + 3, 0, len(name)) + name
+    extensions = struct.pack('>HH', 0, len(extension)) + extension
+    body = (b'\x03\x03' + b'\x00' * 32 + b'\x00' + struct.pack('>H', 4) +
+            b'\xc0\x2f\x00\x9c' + b'\x01\x00' +
+            struct.pack('>H', len(extensions)) + extensions)
+    handshake = b'\x01' + struct.pack('>I', len(body))[1:] + body
+    return b'\x16\x03\x01' + struct.pack('>H', len(handshake)) + handshake
+
+
+def write_pcap(path, frames, nano=False):
+    """frames are (timestamp, data) of Ethernet frames"""
+
+    with open(path, 'wb') as f:
+        f.write(
+            struct.pack('<IHHiIII', 0xa1b23c4d if nano else 0xa1b2c3d4, 2, 4,
+                        0, 0, 65535, 1))
+        for timestamp, data in frames:
+            seconds = int(timestamp)
+            fraction = int(
+                round((timestamp - seconds) * (1e9 if nano else 1e6)))
+            f.write(
+                struct.pack('<IIII', seconds, fraction, len(data), len(data))
+                + data)
+
+
+def write_pcapng(path, frames, tsresol=None):
+    """frames are (timestamp, data) of Ethernet frames. tsresol is the raw
+    value of the if_tsresol option of the interface, microseconds if None
+    """
+
+    def block(kind, body):
+        body += b'\x00' * (-len(body) % 4)
+        return struct.pack('<II', kind, len(body) + 12) + body + struct.pack(
+            '<I', len(body) + 12)
+
+    if tsresol is None:
+        units = 10**6
+        options = b''
+    else:
+        if tsresol & 0x80:
+            units = 2**(tsresol & 0x7f)
+        else:
+            units = 10**tsresol
+        options = struct.pack('<HHB', 9, 1, tsresol) + b'\x00' * 3
+    options += struct.pack('<HH', 0, 0)
+
+    with open(path, 'wb') as f:
+        f.write(block(0x0a0d0d0a, struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1)))
+        f.write(block(1, struct.pack('<HHI', 1, 0, 65535) + options))
+        for timestamp, data in frames:
+            value = int(round(timestamp * units))
+            f.write(
+                block(6,
+                      struct.pack('<IIIII', 0, value >> 32, value & 0xffffffff,
+                                  len(data), len(data)) + data))
@@ -0,0 +1,115 @@
+from backends import (record_from_fields, TSHARK_AGGREGATOR,
+                      TSHARK_FIELD_KEYS)
+from constants import Application, Transport
+
+
+def row(**fields):
+    """Row of tshark output with fields given by name, dots written as
+    underscores
+    """
+
+    values = {k.replace('__', '.'): v for k, v in fields.items()}
+    values.setdefault('frame.time_epoch', '1470000000.5')
+    values.setdefault('frame.len', '100')
+    return [values.get(each, '') for each in TSHARK_FIELD_KEYS]
+
+
+def aggregate(*values):
+    return TSHARK_AGGREGATOR.join(values)
+
+
+def dns_row(names, types, ttls, a='', aaaa='', cname=''):
+    return row(frame__protocols='eth:ethertype:ip:udp:dns',
+               ip__src='8.8.8.8',
+               ip__dst='192.168.0.10',
+               udp__stream='0',
+               udp__srcport='53',
+               udp__dstport='5000',
+               dns__qry__name='www.example.com',
+               dns__resp__name=aggregate(*names),
+               dns__resp__type=aggregate(*types),
+               dns__resp__ttl=aggregate(*ttls),
+               dns__a=a,
+               dns__aaaa=aaaa,
+               dns__cname=cname)
+
+
+def test_dns_cname_chain():
+    record = record_from_fields(
+        dns_row(['www.example.com', 'edge.example.net', 'edge.example.net'],
+                ['5', '1', '28'], ['300', '60', '120'],
+                a='93.184.216.34',
+                aaaa='2001:db8::1',
+                cname='edge.example.net'))
+
+    assert record.application is Application.DNS
+    assert record.transport is Transport.UDP
+    assert record.dns_query == 'www.example.com'
+    assert record.dns_answers == ['93.184.216.34', '2001:db8::1']
+
+
+def test_dns_glue_records_are_excluded():
+    record = record_from_fields(
+        dns_row(['www.example.com', 'ns1.example.com'], ['1', '1'],
+                ['300', '30'],
+                a=aggregate('93.184.216.34', '199.43.135.53')))
+
+    assert record.dns_answers == ['93.184.216.34']
+    assert record.dns_ttl == 300
+
+
+def test_dns_ttl_is_lowest_of_chain():
+    record = record_from_fields(
+        dns_row(['www.example.com', 'edge.example.net', 'edge.example.net'],
+                ['5', '1', '1'], ['45', '60', '120'],
+                a=aggregate('93.184.216.34', '93.184.216.35'),
+                cname='edge.example.net'))
+
+    assert record.dns_answers == ['93.184.216.34', '93.184.216.35']
+    assert record.dns_ttl == 45
+
+
+def test_http_request():
+    record = record_from_fields(
+        row(frame__protocols='eth:ethertype:ip:tcp:http',
+            ip__src='192.168.0.10',
+            ip__dst='93.184.216.34',
+            tcp__stream='7',
+            tcp__srcport='40000',
+            tcp__dstport='80',
+            tcp__flags='0x0018',
+            http__request='1',
+            http__host='www.example.com',
+            http__user_agent='curl/7.50.1'))
+
+    assert record.version == 4
+    assert record.src_address == '192.168.0.10'
+    assert record.dst_address == '93.184.216.34'
+    assert record.transport is Transport.TCP
+    assert (record.src_port, record.dst_port) == (40000, 80)
+    assert record.tcp_flags == 0x18
+    assert record.application is Application.HTTP
+    assert record.http_request
+    assert record.http_host == 'www.example.com'
+    assert record.http_user_agent == 'curl/7.50.1'
+
+
+def test_tls_client_hello_over_ipv6():
+    record = record_from_fields(
+        row(frame__protocols='eth:ethertype:ipv6:tcp:tls',
+            ipv6__src='fe80::1',
+            ipv6__dst='2001:db8::5',
+            tcp__stream='3',
+            tcp__srcport='40001',
+            tcp__dstport='443',
+            tcp__flags='0x0018',
+            tls__handshake__type='1',
+            tls__handshake__ciphersuite=aggregate('0xc02f', '0x009c'),
+            tls__handshake__extensions_server_name='cdn.example.org'))
+
+    assert record.version == 6
+    assert record.dst_address == '2001:db8::5'
+    assert record.application is Application.TLS
+    assert record.tls_client_hello
+    assert record.tls_cipher_suites == [0xc02f, 0x009c]
+    assert record.tls_server_name == 'cdn.example.org'
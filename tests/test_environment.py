@@ -0,0 +1,89 @@
+from constants import (Application, FlowOwner, Transport, TCP_FIN,
+                       FLOW_SWEEP_INTERVAL, CLOSED_FLOW_LINGER)
+from environment import Environment, get_flow_key
+from packets import PacketRecord, parse_address
+
+CLIENT = ('192.168.0.10', 40000)
+SERVER = ('93.184.216.34', 443)
+
+
+def packet(time, src=CLIENT, dst=SERVER, flags=0):
+    """TCP packet whose payload no handler consumes"""
+
+    record = PacketRecord(time, 60)
+    record.version, record.src = parse_address(src[0])
+    record.dst = parse_address(dst[0])[1]
+    record.src_port, record.dst_port = src[1], dst[1]
+    record.transport = Transport.TCP
+    record.tcp_flags = flags
+    record.application = Application.OTHER
+    return record
+
+
+def open_flow(environment, time):
+    pkg = packet(time)
+    environment.update(pkg)
+    environment.assign_flow(pkg, FlowOwner.TEMPORAL, {})
+    return pkg.stream
+
+
+def test_flow_key_is_the_same_in_both_directions():
+    request = packet(0)
+    response = packet(0, src=SERVER, dst=CLIENT)
+
+    assert get_flow_key(request) == get_flow_key(response)
+    assert get_flow_key(request) != get_flow_key(
+        packet(0, src=('192.168.0.10', 40001)))
+
+
+def test_stream_of_flow_is_kept():
+    environment = Environment(None, None, None)
+    stream = open_flow(environment, 0)
+
+    pkg = packet(1, src=SERVER, dst=CLIENT)
+    environment.update(pkg)
+
+    assert pkg.stream == stream
+    assert stream == get_flow_key(pkg) + (0, )
+
+
+def test_closed_flow_is_forgotten_after_linger():
+    environment = Environment(None, None, None)
+    stream = open_flow(environment, 0)
+    environment.update(packet(1, flags=TCP_FIN))
+
+    # Sweeps happen every FLOW_SWEEP_INTERVAL, after the linger
+    assert CLOSED_FLOW_LINGER < FLOW_SWEEP_INTERVAL
+    environment.update(packet(FLOW_SWEEP_INTERVAL - 1, src=('10.0.0.1', 1)))
+    assert environment.flows
+
+    pkg = packet(FLOW_SWEEP_INTERVAL + 1)
+    environment.update(pkg)
+
+    assert environment.generation == 1
+    assert get_flow_key(pkg) not in environment.flows
+    assert pkg.stream != stream
+    assert pkg.stream == stream[:-1] + (1, )
+
+
+def test_open_flow_is_kept_without_idle_timeout():
+    environment = Environment(None, None, None)
+    stream = open_flow(environment, 0)
+
+    pkg = packet(FLOW_SWEEP_INTERVAL * 100)
+    environment.update(pkg)
+
+    assert environment.generation == 0
+    assert pkg.stream == stream
+
+
+def test_idle_flow_is_forgotten():
+    environment = Environment(None, None, None)
+    environment.idle_timeout = 30
+    stream = open_flow(environment, 0)
+
+    pkg = packet(31)
+    environment.update(pkg)
+
+    assert environment.generation == 1
+    assert pkg.stream == stream[:-1] + (1, )
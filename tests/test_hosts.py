@@ -0,0 +1,70 @@
+from hosts import HostCache
+
+
+def test_answer_expires_after_ttl():
+    cache = HostCache()
+    cache.add('93.184.216.34', 'www.example.com', 100, 60)
+
+    assert cache.find('93.184.216.34', 160) == {'www.example.com': 160}
+    assert cache.find('93.184.216.34', 161) is None
+    assert len(cache) == 0
+
+
+def test_answer_without_ttl_does_not_expire():
+    cache = HostCache()
+    cache.add('93.184.216.34', 'www.example.com', 100, None)
+
+    assert cache.find('93.184.216.34', 10**9) == {'www.example.com': None}
+
+
+def test_expired_names_are_dropped_one_by_one():
+    cache = HostCache()
+    cache.add('93.184.216.34', 'www.example.com', 100, 60)
+    cache.add('93.184.216.34', 'example.com', 100, 3600)
+
+    assert cache.find('93.184.216.34', 200) == {'example.com': 3700}
+
+
+def test_renewed_answer_keeps_latest_expiration():
+    cache = HostCache()
+    cache.add('93.184.216.34', 'www.example.com', 100, 60)
+    cache.add('93.184.216.34', 'www.example.com', 50, 60)
+    cache.add('93.184.216.34', 'www.example.com', 150, 60)
+
+    assert cache.find('93.184.216.34', 200) == {'www.example.com': 210}
+
+
+def test_least_recently_used_address_is_evicted():
+    cache = HostCache(2)
+    cache.add('10.0.0.1', 'a.com', 0, None)
+    cache.add('10.0.0.2', 'b.com', 0, None)
+    cache.find('10.0.0.1', 0)
+    cache.add('10.0.0.3', 'c.com', 0, None)
+
+    assert cache.find('10.0.0.2', 0) is None
+    assert cache.find('10.0.0.1', 0) == {'a.com': None}
+    assert cache.get_stats() == {
+        'capacity': 2,
+        'size': 2,
+        'hits': 2,
+        'misses': 1,
+        'evictions': 1
+    }
+
+
+def test_merge_adds_answers_and_counters():
+    cache = HostCache()
+    cache.add('10.0.0.1', 'a.com', 0, 60)
+    cache.find('10.0.0.9', 0)
+
+    other = HostCache()
+    other.add('10.0.0.1', 'a.com', 100, 60)
+    other.add('10.0.0.2', 'b.com', 0, None)
+    other.find('10.0.0.2', 0)
+
+    cache.merge(other)
+
+    assert cache.find('10.0.0.1', 150) == {'a.com': 160}
+    assert cache.find('10.0.0.2', 0) == {'b.com': None}
+    assert cache.get_stats()['hits'] == 3
+    assert cache.get_stats()['misses'] == 1
@@ -0,0 +1,85 @@
+import json
+import shutil
+
+import pytest
+
+import backends
+from environment import Environment
+from models import DeviceLess, ServiceLess
+from tools import main_tools
+
+from captures import (ethernet, ipv4, tcp, udp, dns_response, http_request,
+                      client_hello, write_pcap, TCP_SYN, TCP_FIN)
+
+USER_AGENT = ('Mozilla/5.0 (iPhone; CPU iPhone OS 9_3_2 like Mac OS X) '
+              'AppleWebKit/601.1.46 (KHTML, like Gecko) Version/9.0 '
+              'Mobile/13F69 Safari/601.1')
+
+CLIENT = '192.168.0.10'
+
+
+def capture():
+    frames = []
+
+    def add(src, dst, protocol, payload):
+        frames.append((1470000000 + len(frames) * 0.25,
+                       ethernet(ipv4(src, dst, protocol, payload))))
+
+    add('8.8.8.8', CLIENT, 17,
+        udp(53, 5000,
+            dns_response('www.infobae.com',
+                         [('www.infobae.com', 5, 300, 'cdn.infobae.net'),
+                          ('cdn.infobae.net', 1, 60, '200.1.1.1')])))
+    add(CLIENT, '200.1.1.1', 6, tcp(40000, 80, flags=TCP_SYN))
+    add(CLIENT, '200.1.1.1', 6,
+        tcp(40000, 80, http_request('www.infobae.com', USER_AGENT)))
+    add('200.1.1.1', CLIENT, 6, tcp(80, 40000, b'HTTP/1.1 200 OK\r\n\r\nok'))
+    add('200.1.1.1', CLIENT, 6, tcp(80, 40000, b'z' * 500))
+    add(CLIENT, '200.1.1.1', 6, tcp(40000, 80, flags=TCP_FIN))
+    add(CLIENT, '31.13.64.51', 6,
+        tcp(40001, 443, client_hello('web.whatsapp.com')))
+    add('31.13.64.51', CLIENT, 6,
+        tcp(443, 40001, b'\x17\x03\x03\x00\x05hello'))
+    add(CLIENT, '1.2.3.4', 17, udp(40002, 9999, b'x' * 50))
+    add(CLIENT, '1.2.3.5', 6, tcp(40003, 22, b'SSH-2.0-OpenSSH_7.2\r\n'))
+
+    return frames
+
+
+@pytest.fixture(scope='module')
+def tools():
+    return (main_tools.UserAgentAnalyzer(None),
+            main_tools.InferenceEngine(None),
+            main_tools.ServiceAnalyzer(None))
+
+
+def report(backend, path, tools):
+    environment = Environment(*tools)
+    for pkg in backend.read(path):
+        environment.update(pkg)
+    environment.sort_results()
+
+    return json.dumps(
+        {
+            'devices':
+            [DeviceLess.from_device(each) for each in environment.devices],
+            'authorless_services': [
+                ServiceLess.from_service(each)
+                for each in environment.authorless_services
+            ]
+        },
+        default=lambda o: o.__dict__,
+        sort_keys=True)
+
+
+@pytest.mark.skipif(shutil.which('tshark') is None,
+                    reason='tshark is not installed')
+def test_native_and_tshark_give_the_same_report(tmpdir, tools):
+    path = str(tmpdir.join('capture.pcap'))
+    write_pcap(path, capture())
+
+    native = report(backends.create_backend('native'), path, tools)
+    tshark = report(backends.create_backend('tshark'), path, tools)
+
+    assert json.loads(native)['devices']
+    assert native == tshark
@@ -0,0 +1,55 @@
+import pytest
+
+import errors
+import pcap
+
+from captures import ethernet, ipv4, udp, write_pcap, write_pcapng
+
+FRAMES = [(1470000000.25, ethernet(ipv4('10.0.0.1', '10.0.0.2', 17,
+                                        udp(1000, 2000, b'a' * 10)))),
+          (1470000001.5, ethernet(ipv4('10.0.0.2', '10.0.0.1', 17,
+                                       udp(2000, 1000, b'b' * 20))))]
+
+
+def read(path):
+    with open(str(path), 'rb') as f:
+        return [(timestamp, length, linktype, bytes(data))
+                for timestamp, length, linktype, data in pcap.read_frames(f)]
+
+
+def check(frames, expected):
+    assert len(frames) == len(expected)
+    for (timestamp, length, linktype, data), (time, frame) in zip(
+            frames, expected):
+        assert timestamp == pytest.approx(time, abs=1e-6)
+        assert length == len(frame)
+        assert linktype == 1
+        assert data == frame
+
+
+@pytest.mark.parametrize('nano', [False, True])
+def test_pcap(tmpdir, nano):
+    path = tmpdir.join('capture.pcap')
+    write_pcap(str(path), FRAMES, nano)
+    check(read(path), FRAMES)
+
+
+@pytest.mark.parametrize('tsresol', [None, 6, 9, 0x80 | 20])
+def test_pcapng_timestamp_resolution(tmpdir, tsresol):
+    path = tmpdir.join('capture.pcapng')
+    write_pcapng(str(path), FRAMES, tsresol)
+    check(read(path), FRAMES)
+
+
+def test_truncated_last_frame(tmpdir):
+    path = tmpdir.join('capture.pcap')
+    write_pcap(str(path), FRAMES)
+    path.write_binary(path.read_binary()[:-5])
+    check(read(path), FRAMES[:1])
+
+
+def test_invalid_file(tmpdir):
+    path = tmpdir.join('capture.pcap')
+    path.write_binary(b'not a capture file at all')
+    with pytest.raises(errors.InvalidCaptureFileError):
+        read(path)